@@ -0,0 +1,157 @@
+"""
+    Local stand-in for the DUPR API, serving a SyntheticClub.
+
+    Implements login, get player, player match history (POST, and GET with
+    limit/offset) and club members, with the real paging envelope
+    {"status", "result": {"total", "offset", "limit", "hits"}}. A page
+    limit above max_limit gets a 400, like the real API, so the client's
+    page size probing is exercised too. Every request can be delayed by
+    latency seconds (plus random jitter) to look like a real network.
+
+        python bench/fake_dupr.py --matches 10000 --latency 0.05 --port 8765
+        DUPR_API_URL=http://127.0.0.1:8765 python duprly.py --db bench.sqlite get-data
+"""
+import base64
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import click
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from synth import SyntheticClub, club_size  # noqa: E402
+
+CLUB_ID = "1"
+
+
+def make_token(ttl: float = 3600) -> str:
+    """ Unsigned JWT, DuprClient only reads its exp """
+    payload = json.dumps({"exp": int(time.time() + ttl)}).encode()
+    return "eyJhbGciOiJub25lIn0." + base64.urlsafe_b64encode(payload).decode().rstrip("=") + ".x"
+
+
+class FakeDupr(object):
+
+    def __init__(self, club: SyntheticClub, port: int = 0, latency: float = 0.0,
+                 jitter: float = 0.0, max_limit: int = 50):
+        self.club = club
+        self.history = club.histories()
+        self.latency = latency
+        self.jitter = jitter
+        self.max_limit = max_limit
+        self.requests = 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self) -> "FakeDupr":
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def delay(self):
+        if self.latency or self.jitter:
+            time.sleep(self.latency + random.uniform(0, self.jitter))
+
+    def page(self, items: list, offset: int, limit: int) -> tuple[int, dict]:
+        if limit > self.max_limit:
+            return 400, {"status": "FAILURE", "message": f"limit must be <= {self.max_limit}"}
+        return 200, {"status": "SUCCESS", "result": {
+            "total": len(items),
+            "offset": offset,
+            "limit": limit,
+            "hits": items[offset:offset + limit],
+        }}
+
+    def route(self, method: str, path: str, body: dict) -> tuple[int, dict]:
+        url = urlparse(path)
+        if method == "POST" and url.path == "/auth/v1.0/login/":
+            return 200, {"status": "SUCCESS", "result": {"accessToken": make_token()}}
+        m = re.fullmatch(r"/player/v1\.0/(\d+)", url.path)
+        if m and method == "GET":
+            pid = int(m.group(1))
+            if pid not in self.club.by_id:
+                return 404, {"status": "FAILURE"}
+            return 200, {"status": "SUCCESS", "result": self.club.player_json(pid)}
+        m = re.fullmatch(r"/player/v1\.0/(\d+)/history", url.path)
+        if m:
+            if method == "GET":
+                q = parse_qs(url.query)
+                body = {"offset": int(q.get("offset", [0])[0]), "limit": int(q.get("limit", [10])[0])}
+            hits = self.history.get(int(m.group(1)), [])
+            return self.page(hits, body.get("offset", 0), body.get("limit", 10))
+        if re.fullmatch(r"/club/\w+/members/v1\.0/all", url.path) and method == "POST":
+            return self.page(self.club.members, body.get("offset", 0), body.get("limit", 20))
+        return 404, {"status": "FAILURE", "message": "not found"}
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def reply(self, method: str):
+                n = int(self.headers.get("Content-Length") or 0)
+                body = json.loads(self.rfile.read(n)) if n else {}
+                fake.requests += 1
+                fake.delay()
+                if not self.path.startswith("/auth") and \
+                        not self.headers.get("Authorization", "").startswith("Bearer ey"):
+                    status, data = 401, {"status": "FAILURE"}
+                else:
+                    status, data = fake.route(method, self.path, body)
+                content = json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def do_GET(self):
+                self.reply("GET")
+
+            def do_POST(self):
+                self.reply("POST")
+
+        return Handler
+
+
+@click.command()
+@click.option("--matches", default=1000, help="number of matches")
+@click.option("--members", type=int, help="club members (default about 50 matches each)")
+@click.option("--seed", default=1)
+@click.option("--port", default=8765)
+@click.option("--latency", default=0.0, help="seconds added to every request")
+@click.option("--jitter", default=0.0, help="random extra seconds, up to this")
+@click.option("--max-limit", default=50, help="largest page size, larger gets a 400")
+def main(matches: int, members: int, seed: int, port: int, latency: float, jitter: float, max_limit: int):
+    """ Serve a synthetic club as a fake DUPR API """
+    club = SyntheticClub(members or club_size(matches), matches, seed)
+    fake = FakeDupr(club, port, latency, jitter, max_limit)
+    print(f"fake DUPR API at {fake.url}, club {CLUB_ID}: "
+          f"{club.n_members} members, {len(club.players)} players, {matches} matches")
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+"""
+    Benchmarks for the sync and database code, on synthetic club data.
+
+        python bench/run.py                              # all, 1k and 100k matches
+        python bench/run.py --sizes 1M -b ingest -b match-detail
+        python bench/run.py -b get-data --sizes 10k --latency 0.05 --jitter 0.05
+
+    benchmarks:
+        get-data      duprly.py get-data end to end against the fake API
+        replay        get-data --record against the fake API, then --replay
+                      offline into a new database, which must get the same counts
+        players       Player.bulk_upsert of all players, new and then again
+        ingest        match history pages through SyncIdentityMap, commit per page
+        match-detail  full MatchDetail.build
+
+    Each size is a number of matches (1k, 100k, 1M), the club has about
+    50 matches per member. Every run uses a fresh database in a temp dir.
+"""
+import itertools
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, HERE)
+sys.path.insert(0, ROOT)
+
+from loguru import logger  # noqa: E402
+from dupr_db import DB_PROFILES, Match, MatchDetail, Player, SyncIdentityMap, open_db  # noqa: E402
+from dupr_resources import decode_matches, decode_players  # noqa: E402
+from fake_dupr import CLUB_ID, FakeDupr  # noqa: E402
+from synth import SyntheticClub, club_size  # noqa: E402
+
+BENCHMARKS = ("get-data", "replay", "players", "ingest", "match-detail")
+
+
+def parse_size(s: str) -> int:
+    s = s.strip().lower()
+    mult = {"k": 1000, "m": 1000000}.get(s[-1:], 1)
+    return int(float(s.rstrip("km")) * mult)
+
+
+def result(bench: str, size: int, seconds: float, count: int, unit: str, **extra) -> dict:
+    return dict(bench=bench, size=size, seconds=round(seconds, 3), count=count, unit=unit,
+                rate=round(count / seconds, 1) if seconds else None, **extra)
+
+
+def bench_players(club: SyntheticClub, eng) -> list:
+    out = []
+    for step in ("insert", "update"):
+        members = [club.player_json(p["id"]) for p in club.players]
+        with Session(eng) as sess:
+            t = time.perf_counter()
+            Player.bulk_upsert(sess, decode_players(members))
+            sess.commit()
+            out.append(result("players", club.n_matches, time.perf_counter() - t,
+                              len(members), "players", step=step))
+    return out
+
+
+def bench_ingest(club: SyntheticClub, eng, page: int) -> list:
+    spent = 0.0
+    with Session(eng) as sess:
+        idmap = SyncIdentityMap().preload(sess)
+        matches = club.iter_matches()
+        while True:
+            # generating the json is not timed
+            hits = list(itertools.islice(matches, page))
+            if not hits:
+                break
+            t = time.perf_counter()
+            idmap.add_matches(sess, decode_matches(hits))
+            sess.commit()
+            spent += time.perf_counter() - t
+        n = sess.scalar(select(func.count(Match.id)))
+    return [result("ingest", club.n_matches, spent, n, "matches", page=page)]
+
+
+def bench_match_detail(club: SyntheticClub, eng) -> list:
+    with Session(eng) as sess:
+        t = time.perf_counter()
+        n = MatchDetail.build(sess)
+        sess.commit()
+    return [result("match-detail", club.n_matches, time.perf_counter() - t, n, "rows")]
+
+
+def run_duprly(tmp: str, url: str, options: list, args: tuple, verbose: bool) -> float:
+    """ Run duprly.py get-data in tmp against the fake API, return the seconds taken """
+    env = dict(os.environ, DUPR_API_URL=url, DUPR_CLUB_ID=CLUB_ID,
+               DUPR_USERNAME="bench", DUPR_PASSWORD="bench", HOME=tmp,
+               DUPR_CACHE_PATH=os.path.join(tmp, "cache.sqlite"))
+    cmd = [sys.executable, os.path.join(ROOT, "duprly.py"), *options, "get-data", *args]
+    t = time.perf_counter()
+    subprocess.run(cmd, cwd=tmp, env=env, check=True,
+                   stdout=None if verbose else subprocess.DEVNULL,
+                   stderr=None if verbose else subprocess.DEVNULL)
+    return time.perf_counter() - t
+
+
+def db_counts(db: str) -> dict:
+    eng = open_db(db)
+    with Session(eng) as sess:
+        counts = {"players": sess.scalar(select(func.count(Player.id))),
+                  "matches": sess.scalar(select(func.count(Match.id)))}
+    eng.dispose()
+    return counts
+
+
+def bench_get_data(club: SyntheticClub, tmp: str, latency: float, jitter: float,
+                   args: tuple, verbose: bool) -> list:
+    fake = FakeDupr(club, latency=latency, jitter=jitter).start()
+    db = os.path.join(tmp, "get_data.sqlite")
+    metrics = os.path.join(tmp, "get_data.json")
+    try:
+        seconds = run_duprly(tmp, fake.url, ["--db", db, "--no-cache", "--no-archive", "--no-rate-limit",
+                                             "--metrics-json", metrics], args, verbose)
+    finally:
+        fake.stop()
+    with open(metrics) as f:
+        m = json.load(f)
+    n = db_counts(db)["matches"]
+    return [result("get-data", club.n_matches, seconds, n, "matches",
+                   requests=fake.requests, latency=latency,
+                   sql_seconds=m["db"]["sql_seconds"], commit_seconds=m["db"]["commit_seconds"])]
+
+
+def bench_replay(club: SyntheticClub, tmp: str, args: tuple, verbose: bool) -> list:
+    fake = FakeDupr(club).start()
+    recorded = os.path.join(tmp, "record.sqlite")
+    try:
+        run_duprly(tmp, fake.url, ["--db", recorded, "--record", "--no-archive", "--no-rate-limit"],
+                   args, verbose)
+    finally:
+        fake.stop()
+    # the fake API is gone, so any request not in the recording fails
+    replayed = os.path.join(tmp, "replay.sqlite")
+    seconds = run_duprly(tmp, fake.url, ["--db", replayed, "--replay", "--no-rate-limit"], args, verbose)
+    want, got = db_counts(recorded), db_counts(replayed)
+    if got != want:
+        raise click.ClickException(f"replay gave {got}, the recorded run {want}")
+    return [result("replay", club.n_matches, seconds, got["matches"], "matches", requests=fake.requests)]
+
+
+@click.command()
+@click.option("--sizes", default="1k,100k", help="comma separated match counts, e.g. 1k,100k,1M")
+@click.option("-b", "--bench", "benches", multiple=True, type=click.Choice(BENCHMARKS),
+              help="benchmark to run, repeat for several (default all)")
+@click.option("--seed", default=1, help="synthetic data seed")
+@click.option("--latency", default=0.0, help="seconds added to every fake API request")
+@click.option("--jitter", default=0.0, help="random extra seconds per request, up to this")
+@click.option("--db-profile", type=click.Choice(list(DB_PROFILES)), default="default")
+@click.option("--page", default=500, help="matches per committed page for ingest")
+@click.option("--get-data-args", default="", help="extra get-data options, e.g. '--concurrency 8'")
+@click.option("--json", "json_path", help="also write the results to this json file")
+@click.option("--keep", is_flag=True, help="keep the temp databases")
+@click.option("--verbose", is_flag=True, help="show the log output")
+def main(sizes: str, benches: tuple, seed: int, latency: float, jitter: float, db_profile: str,
+         page: int, get_data_args: str, json_path: str, keep: bool, verbose: bool):
+    """ Run the benchmarks and print a table of the results """
+    if not verbose:
+        logger.remove()
+    benches = benches or BENCHMARKS
+    results = []
+    for size in [parse_size(s) for s in sizes.split(",")]:
+        t = time.perf_counter()
+        club = SyntheticClub(club_size(size), size, seed)
+        click.echo(f"{size} matches: {club.n_members} members, {len(club.players)} players "
+                   f"(setup {time.perf_counter() - t:.1f}s)", err=True)
+        tmp = tempfile.mkdtemp(prefix="duprly_bench_")
+        try:
+            if "get-data" in benches:
+                results += bench_get_data(club, tmp, latency, jitter, tuple(get_data_args.split()), verbose)
+            if "replay" in benches:
+                results += bench_replay(club, tmp, tuple(get_data_args.split()), verbose)
+            eng = open_db(os.path.join(tmp, "bench.sqlite"), db_profile)
+            # each step builds on the data of the one before
+            if {"players", "ingest", "match-detail"} & set(benches):
+                results += bench_players(club, eng)
+            if {"ingest", "match-detail"} & set(benches):
+                results += bench_ingest(club, eng, page)
+            if "match-detail" in benches:
+                results += bench_match_detail(club, eng)
+            eng.dispose()
+        finally:
+            if keep:
+                click.echo(f"databases kept in {tmp}", err=True)
+            else:
+                shutil.rmtree(tmp, ignore_errors=True)
+        # steps run only as setup for a later one are not reported
+        results = [r for r in results if r["bench"] in benches]
+
+    click.echo(f"{'benchmark':<14}{'size':>10}{'seconds':>10}{'count':>10}  rate")
+    for r in results:
+        step = f" ({r['step']})" if "step" in r else ""
+        click.echo(f"{r['bench']:<14}{r['size']:>10}{r['seconds']:>10.2f}{r['count']:>10}"
+                   f"  {r['rate'] or 0:.0f} {r['unit']}/s{step}")
+    if json_path:
+        with open(json_path, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
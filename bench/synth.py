@@ -0,0 +1,136 @@
+"""
+    Seeded synthetic club data in the shape of the DUPR API json.
+
+    A club has `members` players plus a pool of outside players they meet
+    in matches. Players get a skill level, and each match is played by a
+    club member against players close to them on the ladder, so the same
+    partners and opponents come back again and again like in a real club.
+    Some matches are singles, some ratings are NR, dates cover two years.
+
+    The same seed always gives the same club.
+"""
+import random
+from datetime import date, timedelta
+from typing import Iterator
+
+LAST_DAY = date(2024, 6, 30)
+DAYS = 730
+# ladder neighbourhood that partners and opponents are picked from
+NEIGHBOURS = 12
+
+
+def club_size(matches: int) -> int:
+    """ Members for a club with this many matches, about 50 matches each """
+    return max(20, matches // 50)
+
+
+class SyntheticClub(object):
+
+    def __init__(self, members: int, matches: int, seed: int = 1,
+                 singles: float = 0.2, outsiders: float = 2.0, not_rated: float = 0.15):
+        self.n_members = members
+        self.n_matches = matches
+        self.seed = seed
+        self.singles = singles
+        rnd = random.Random(seed)
+        self.players = [self._player(rnd, i, not_rated)
+                        for i in range(members + int(members * outsiders))]
+        self.by_id = {p["id"]: p for p in self.players}
+        self.skill = {p["id"]: rnd.gauss(3.5, 0.6) for p in self.players}
+        self.ladder = sorted(self.by_id, key=self.skill.get)
+        self.rank = {pid: n for n, pid in enumerate(self.ladder)}
+
+    @property
+    def members(self) -> list:
+        return self.players[:self.n_members]
+
+    @staticmethod
+    def _player(rnd: random.Random, i: int, not_rated: float) -> dict:
+        pid = 100000 + i
+        doubles = None if rnd.random() < not_rated else round(rnd.uniform(2.5, 5.5), 3)
+        singles = None if rnd.random() < 0.6 else round(rnd.uniform(2.5, 5.5), 3)
+        return {
+            "id": pid,
+            "duprId": f"{pid % 997:03d}X{pid}",
+            "fullName": f"Player {i}",
+            "imageUrl": None,
+            "email": f"player{i}@example.com",
+            "gender": rnd.choice(("MALE", "FEMALE")),
+            "age": rnd.randint(18, 80),
+            "ratings": {
+                "doubles": f"{doubles}" if doubles else "NR",
+                "doublesVerified": f"{doubles}" if doubles and rnd.random() < 0.5 else "NR",
+                "doublesProvisional": doubles is None or rnd.random() < 0.2,
+                "singles": f"{singles}" if singles else "NR",
+                "singlesVerified": "NR",
+                "singlesProvisional": True,
+            },
+        }
+
+    def player_json(self, pid: int) -> dict:
+        """ What the get player call returns, a copy the caller can change """
+        p = self.by_id[pid]
+        return dict(p, ratings=dict(p["ratings"]))
+
+    def _ref(self, pid: int) -> dict:
+        """ Player as it appears in a match, only a few fields """
+        p = self.by_id[pid]
+        return {"id": pid, "fullName": p["fullName"], "duprId": p["duprId"]}
+
+    def _neighbours(self, rnd: random.Random, pid: int, n: int) -> list:
+        at = self.rank[pid]
+        near = self.ladder[max(0, at - NEIGHBOURS):at + NEIGHBOURS + 1]
+        return rnd.sample([p for p in near if p != pid], n)
+
+    def _team(self, rnd: random.Random, players: list, score: int, winner: bool) -> dict:
+        team = {
+            "game1": score,
+            "winner": winner,
+            "player1": self._ref(players[0]),
+        }
+        if len(players) > 1:
+            team["player2"] = self._ref(players[1])
+        return team
+
+    def iter_matches(self) -> Iterator[dict]:
+        """ All matches, generated one at a time in match id order """
+        rnd = random.Random(self.seed + 1)
+        for n in range(self.n_matches):
+            member = self.players[rnd.randrange(self.n_members)]["id"]
+            doubles = rnd.random() >= self.singles
+            others = self._neighbours(rnd, member, 3 if doubles else 1)
+            if doubles:
+                team1, team2 = [member, others[0]], others[1:]
+            else:
+                team1, team2 = [member], others
+            s1 = sum(self.skill[p] for p in team1)
+            s2 = sum(self.skill[p] for p in team2)
+            team1_wins = rnd.random() < 1 / (1 + 10 ** ((s2 - s1) / (1.0 * len(team1))))
+            loser_score = rnd.randint(0, 9)
+            day = LAST_DAY - timedelta(days=rnd.randrange(DAYS))
+            yield {
+                "matchId": 5000000 + n,
+                "eventDate": day.isoformat(),
+                "eventName": f"Club night {day.isoformat()}",
+                "eventFormat": "DOUBLES" if doubles else "SINGLES",
+                "matchType": "SIDE_ONLY",
+                "matchSource": "CLUB",
+                "matchScoreAdded": True,
+                "confirmed": True,
+                "teams": [
+                    self._team(rnd, team1, 11 if team1_wins else loser_score, team1_wins),
+                    self._team(rnd, team2, loser_score if team1_wins else 11, not team1_wins),
+                ],
+            }
+
+    def histories(self) -> dict:
+        """ dupr id -> match history, newest first, as the history call pages it """
+        history = {}
+        for m in self.iter_matches():
+            for t in m["teams"]:
+                for k in ("player1", "player2"):
+                    if k in t:
+                        history.setdefault(t[k]["id"], []).append(m)
+        for hits in history.values():
+            hits.sort(key=lambda m: (m["eventDate"], m["matchId"]), reverse=True)
+        return history
@@ -0,0 +1,119 @@
+"""
+    Vectorized rating analytics over match_detail.
+
+    match_detail and the current ratings are loaded once into NumPy arrays,
+    every metric is computed for all matches at once, and the results are
+    written back to match_analytics with one executemany.
+
+    Ratings are the current ones (doubles for doubles matches, singles for
+    singles), not the rating at the time of the match.
+"""
+import numpy as np
+from loguru import logger
+from sqlalchemy import delete
+from sqlalchemy.orm import Session
+
+from dupr_db import MatchAnalytics
+
+COLUMNS = ("match_id", "team_1_rating", "team_2_rating", "rating_diff", "rating_spread",
+           "team_1_win_prob", "team_1_won", "upset")
+
+
+def load_ratings(sess: Session) -> tuple[np.ndarray, np.ndarray]:
+    """ doubles and singles ratings indexed by player.id, NaN if unrated.
+        Index 0 is never a player id, so it stands for "no player".
+    """
+    rows = sess.connection().exec_driver_sql(
+        "SELECT player_id, doubles, singles FROM rating").fetchall()
+    a = np.array(rows, dtype=float).reshape(-1, 3)
+    size = int(a[:, 0].max()) + 1 if len(a) else 1
+    doubles = np.full(size, np.nan)
+    singles = np.full(size, np.nan)
+    ids = a[:, 0].astype(np.int64)
+    doubles[ids] = a[:, 1]
+    singles[ids] = a[:, 2]
+    return doubles, singles
+
+
+def load_matches(sess: Session) -> np.ndarray:
+    """ match_id, team 1 / 2 score, the four player ids and whether team 1
+        won, NaN if missing. The scores in match_detail are game 1 only, so
+        the winner comes from match_team, with team 1 picked the same way
+        as MatchDetail.BUILD_SQL does.
+    """
+    rows = sess.connection().exec_driver_sql(
+        "SELECT md.match_id, team_1_score, team_2_score, "
+        "team_1_player_1_id, team_1_player_2_id, team_2_player_1_id, team_2_player_2_id, "
+        "team.is_winner "
+        "FROM match_detail AS md LEFT JOIN ("
+        "  SELECT match_id, is_winner, "
+        "         row_number() OVER (PARTITION BY match_id ORDER BY id) AS team_no "
+        "  FROM match_team"
+        ") AS team ON team.match_id = md.match_id AND team.team_no = 1").fetchall()
+    return np.array(rows, dtype=float).reshape(-1, 8)
+
+
+def _team_mean(r: np.ndarray) -> np.ndarray:
+    """ mean of the known ratings of each row, NaN if none """
+    known = ~np.isnan(r)
+    n = known.sum(axis=1)
+    total = np.where(known, r, 0.0).sum(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(n > 0, total / n, np.nan)
+
+
+def compute(md: np.ndarray, doubles: np.ndarray, singles: np.ndarray,
+            scale: float = 0.5, upset_threshold: float = 0.35) -> dict:
+    """
+    Metrics for every match, as arrays keyed by column name.
+
+    Win probability is logistic in the team rating difference:
+    1 / (1 + 10 ** (-diff / scale)), so with scale 0.5 a team rated
+    0.5 higher is expected to win 91% of the time. A match is an upset
+    when the winning team's expected probability was below upset_threshold.
+    """
+    ids = np.nan_to_num(md[:, 3:7], nan=0).astype(np.int64)
+    ids[ids >= len(doubles)] = 0
+    is_doubles = ids[:, 1] > 0
+    r = np.where(is_doubles[:, None], doubles[ids], singles[ids])
+    r[ids == 0] = np.nan
+
+    t1 = _team_mean(r[:, :2])
+    t2 = _team_mean(r[:, 2:])
+    diff = t1 - t2
+    spread = np.fmax.reduce(r, axis=1) - np.fmin.reduce(r, axis=1)
+    prob = 1.0 / (1.0 + np.power(10.0, -diff / scale))
+    won = md[:, 7] == 1
+    winner_prob = np.where(won, prob, 1.0 - prob)
+    upset = np.nan_to_num(winner_prob, nan=1.0) < upset_threshold
+    return {
+        "match_id": md[:, 0].astype(np.int64),
+        "team_1_rating": t1,
+        "team_2_rating": t2,
+        "rating_diff": diff,
+        "rating_spread": spread,
+        "team_1_win_prob": prob,
+        "team_1_won": won,
+        "upset": upset,
+    }
+
+
+def save(sess: Session, metrics: dict) -> int:
+    """ Replace match_analytics with the metrics, in one executemany.
+        NaN is stored as NULL by sqlite. Caller commits.
+    """
+    sess.execute(delete(MatchAnalytics))
+    rows = zip(*[metrics[c].tolist() for c in COLUMNS])
+    sql = (f"INSERT INTO match_analytics ({', '.join(COLUMNS)}) "
+           f"VALUES ({', '.join('?' * len(COLUMNS))})")
+    sess.connection().exec_driver_sql(sql, list(rows))
+    return len(metrics["match_id"])
+
+
+def analyze(sess: Session, scale: float = 0.5, upset_threshold: float = 0.35) -> int:
+    doubles, singles = load_ratings(sess)
+    md = load_matches(sess)
+    metrics = compute(md, doubles, singles, scale, upset_threshold)
+    n = save(sess, metrics)
+    logger.info(f"analyzed {n} matches, {int(metrics['upset'].sum())} upsets")
+    return n
@@ -0,0 +1,86 @@
+"""
+    Append-only archive of raw DUPR API responses.
+
+    Every successful response fetched from the network is appended as one
+    json line to a gzip file partitioned by call name and date:
+
+        dupr_archive/get_member_match_history/2024-05-01.jsonl.gz
+
+    Each line is {"name", "method", "url", "body", "fetched_at", "response"}
+    where response is the raw json returned by the API. The database can be
+    rebuilt from it without network access (duprly.py rebuild-db), so a
+    parsing fix does not need a re-crawl.
+"""
+import gzip
+import json
+import os
+import threading
+import time
+from datetime import date
+from typing import Iterator
+
+from loguru import logger
+
+
+class RawArchive(object):
+
+    def __init__(self, path: str = None):
+        self.path = path or os.getenv("DUPR_ARCHIVE_DIR") or "dupr_archive"
+        self.files = {}
+        self.lock = threading.Lock()
+        self.written = 0
+
+    def _file(self, name: str):
+        """ Open (append) gzip file for today's partition of this call name """
+        part = (name, date.today().isoformat())
+        f = self.files.get(part)
+        if f is None:
+            d = os.path.join(self.path, name or "unknown")
+            os.makedirs(d, exist_ok=True)
+            # appending adds a new gzip member, readers see one stream
+            f = gzip.open(os.path.join(d, f"{part[1]}.jsonl.gz"), "ab")
+            self.files[part] = f
+        return f
+
+    def write(self, name: str, method: str, url: str, body, content: bytes):
+        """ Append one raw response """
+        raw = content.decode("utf-8")
+        if "\n" in raw:
+            raw = json.dumps(json.loads(raw))
+        head = json.dumps({
+            "name": name,
+            "method": method,
+            "url": url,
+            "body": body,
+            "fetched_at": time.time(),
+        })
+        # splice the raw response in, no need to decode and encode it
+        line = f'{head[:-1]}, "response": {raw}}}\n'
+        with self.lock:
+            self._file(name).write(line.encode("utf-8"))
+            self.written += 1
+
+    def close(self):
+        with self.lock:
+            for f in self.files.values():
+                f.close()
+            self.files = {}
+
+    def records(self, name: str) -> Iterator[dict]:
+        """ Stream the archived records of a call name, oldest first """
+        d = os.path.join(self.path, name)
+        if not os.path.isdir(d):
+            return
+        for fname in sorted(os.listdir(d)):
+            if not fname.endswith(".jsonl.gz"):
+                continue
+            try:
+                with gzip.open(os.path.join(d, fname), "rt", encoding="utf-8") as f:
+                    for n, line in enumerate(f):
+                        try:
+                            yield json.loads(line)
+                        except json.JSONDecodeError:
+                            logger.warning(f"skip bad archive line {name}/{fname}:{n}")
+            except (EOFError, gzip.BadGzipFile):
+                # an interrupted run can leave the last gzip member torn
+                logger.warning(f"truncated archive file {name}/{fname}")
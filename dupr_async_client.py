@@ -0,0 +1,271 @@
+"""
+    An asyncio counterpart of DuprClient for crawling many players at once.
+
+    It shares the login / access token of a (sync) DuprClient, and exposes
+    the same read calls as coroutines. All requests go through one pooled
+    httpx.AsyncClient and a semaphore that bounds how many are in flight.
+
+    Identical calls that are already in flight are coalesced, so two
+    workers asking for the same player's history share one fetch.
+
+    Connection errors, timeouts and 5xx responses are retried with the
+    backoff of the sync client's DuprTransport. A request that still
+    fails on a connection error or timeout returns a 599 response
+    instead of raising, so one bad player does not end a whole crawl.
+
+    Usage:
+
+        dupr = DuprClient()
+        dupr.auth_user(username, password)
+        async with AsyncDuprClient(dupr, concurrency=8) as adupr:
+            rc, hits = await adupr.get_member_match_history_p(dupr_id)
+
+"""
+import asyncio
+import time
+from typing import Awaitable, Callable, Optional
+
+import httpx
+from loguru import logger
+
+from dupr_client import DuprClient
+from dupr_resources import loads
+
+
+class AsyncDuprClient(object):
+
+    def __init__(self, client: DuprClient, concurrency: int = 8, timeout: float = None):
+        self.client = client
+        self.version = client.version
+        self.concurrency = concurrency
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.http = httpx.AsyncClient(
+            base_url=client.env_url,
+            timeout=timeout or client.transport.timeout,
+            limits=httpx.Limits(max_connections=concurrency,
+                                max_keepalive_connections=concurrency),
+            headers={'Accept-Encoding': 'gzip, deflate'},
+        )
+        self._inflight: dict[tuple, asyncio.Future] = {}
+        self._probing: dict[str, asyncio.Lock] = {}
+
+    async def __aenter__(self) -> "AsyncDuprClient":
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
+
+    async def aclose(self):
+        await self.http.aclose()
+
+    async def _coalesce(self, key: tuple, factory: Callable[[], Awaitable]):
+        """ Run factory() once per key while it is in flight,
+            later callers with the same key await the same result.
+        """
+        fut = self._inflight.get(key)
+        if fut is not None:
+            logger.debug(f'coalesced: {key}')
+            return await asyncio.shield(fut)
+        fut = asyncio.ensure_future(factory())
+        self._inflight[key] = fut
+        try:
+            return await asyncio.shield(fut)
+        finally:
+            if self._inflight.get(key) is fut:
+                del self._inflight[key]
+
+    def cached_response(self, method: str, url: str, body, name: str,
+                        fresh: bool = False) -> Optional[httpx.Response]:
+        """ Same cache as the sync client, see DuprClient.cached_response """
+        r = self.client.cached_response(method, url, body, name, fresh)
+        if r is None:
+            return None
+        return httpx.Response(r.status_code, content=r.content,
+                              headers={'Content-Type': 'application/json'})
+
+    async def ensure_token(self) -> str:
+        """ Token to use, logging in again first if it is about to expire.
+            The (blocking) login runs in a thread, the sync client's lock
+            makes sure only one task logs in.
+        """
+        if self.client.username and self.client.token_expiring():
+            await asyncio.to_thread(self.client.ensure_token)
+        return self.client.access_token
+
+    async def refresh_user(self, stale_token: str) -> int:
+        return await asyncio.to_thread(self.client.refresh_user, stale_token)
+
+    async def request(self, method: str, url: str, **kwargs) -> tuple[httpx.Response, int]:
+        """ One request with the retry policy of DuprTransport,
+            returns the response and the number of retries.
+        """
+        transport = self.client.transport
+        for attempt in range(transport.retries + 1):
+            if attempt:
+                await asyncio.sleep(transport.backoff * 2 ** (attempt - 1))
+            try:
+                r = await self.http.request(method, url, headers=self.client.headers(), **kwargs)
+            except httpx.TransportError as e:
+                logger.warning(f'{method} {url} failed: {e!r}')
+                r = httpx.Response(599)
+            if r.status_code not in transport.RETRY_STATUS + (599,):
+                break
+        return r, attempt
+
+    async def send(self, method: str, url: str, name: str, **kwargs) -> httpx.Response:
+        """ Async DuprClient.send, sharing the client's rate limiter """
+        limiter = self.client.limiter
+        for attempt in range(self.client.THROTTLE_RETRIES + 1):
+            if limiter:
+                await limiter.acquire_async(name)
+            t0 = time.perf_counter()
+            r, retries = await self.request(method, url, **kwargs)
+            if self.client.metrics:
+                self.client.metrics.request(name, r.status_code, time.perf_counter() - t0,
+                                            len(r.content), retries + (attempt > 0))
+            if not limiter:
+                break
+            limiter.feedback(name, r.status_code, r.headers.get('Retry-After'))
+            if r.status_code != 429:
+                break
+        return r
+
+    async def dupr_get(self, url, name: str = "", fresh: bool = False) -> httpx.Response:
+        r = self.cached_response('GET', url, None, name, fresh)
+        if r is not None:
+            return r
+        async with self.semaphore:
+            logger.debug(f'GET: {name} : {url}')
+            token = await self.ensure_token()
+            r = await self.send('GET', url, name)
+            logger.debug(f'return: {r.status_code}')
+            if r.status_code in (401, 403) and await self.refresh_user(token) == 200:
+                r = await self.send('GET', url, name)
+        self.client.cache_response('GET', url, None, name, r)
+        return r
+
+    async def dupr_post(self, url, json_data=None, name: str = "") -> httpx.Response:
+        r = self.cached_response('POST', url, json_data, name)
+        if r is not None:
+            return r
+        async with self.semaphore:
+            logger.debug(f'POST: {name} : {url}')
+            token = await self.ensure_token()
+            r = await self.send('POST', url, name, json=json_data)
+            logger.debug(f'return: {r.status_code}')
+            if r.status_code in (401, 403) and await self.refresh_user(token) == 200:
+                r = await self.send('POST', url, name, json=json_data)
+        self.client.cache_response('POST', url, json_data, name, r)
+        return r
+
+    async def get_player(self, player_id: str, fresh: bool = False) -> tuple[int, Optional[dict]]:
+        async def fetch():
+            r = await self.dupr_get(f'/player/{self.version}/{player_id}', "get_player", fresh)
+            if r.status_code == 200:
+                return r.status_code, loads(r.content)["result"]
+            return r.status_code, None
+        return await self._coalesce(("get_player", str(player_id), fresh), fetch)
+
+    async def first_page(self, endpoint: str,
+                         request: Callable[[int, int], Awaitable[httpx.Response]],
+                         default_limit: int = 10) -> tuple[httpx.Response, Optional[dict], int]:
+        """ Async DuprClient.first_page: until the endpoint's page size is
+            learnt one task at a time probes it, the others wait for it.
+        """
+        self.client.page_limit(endpoint)
+        if endpoint in self.client.page_limits:
+            return await self._first_page(endpoint, request, default_limit)
+        async with self._probing.setdefault(endpoint, asyncio.Lock()):
+            return await self._first_page(endpoint, request, default_limit)
+
+    async def _first_page(self, endpoint: str,
+                          request: Callable[[int, int], Awaitable[httpx.Response]],
+                          default_limit: int) -> tuple[httpx.Response, Optional[dict], int]:
+        client = self.client
+        limit = client.page_limit(endpoint)
+        while True:
+            r = await request(0, limit)
+            if r.status_code != 400:
+                break
+            limit = client.retry_page_limit(endpoint, limit, default_limit)
+            if not limit:
+                break
+        if r.status_code != 200:
+            return r, None, limit
+        json_data = loads(r.content)
+        return r, json_data, client.learn_page_limit(endpoint, limit, json_data)
+
+    async def paged_fetch(self, endpoint: str,
+                          request: Callable[[int, int], Awaitable[httpx.Response]],
+                          default_limit: int = 10,
+                          stop_when: Callable[[list], bool] = None) -> tuple[int, list]:
+        """ Async version of DuprClient.paged_fetch, sharing its learnt
+            page sizes. Remaining pages are gathered at once, the semaphore
+            bounds how many are in flight.
+        """
+        r, json_data, limit = await self.first_page(endpoint, request, default_limit)
+        if r.status_code != 200:
+            return r.status_code, []
+
+        total = json_data["result"]["total"]
+        hit_data = list(json_data["result"]["hits"])
+        # no first page, whatever the total says
+        offsets = list(range(len(hit_data), total, limit)) if hit_data else []
+
+        if stop_when:
+            if not offsets or stop_when(hit_data):
+                return r.status_code, hit_data
+            for offset in offsets:
+                r = await request(offset, limit)
+                if r.status_code != 200:
+                    return r.status_code, hit_data
+                hits = loads(r.content)["result"]["hits"]
+                hit_data.extend(hits)
+                if stop_when(hits):
+                    break
+            return r.status_code, hit_data
+
+        responses = await asyncio.gather(*[request(o, limit) for o in offsets])
+        for r in responses:
+            if r.status_code != 200:
+                return r.status_code, hit_data
+            hit_data.extend(loads(r.content)["result"]["hits"])
+        return 200, hit_data
+
+    async def get_member_match_history_p(self, member_id: str,
+                                         stop_when: Callable[[list], bool] = None) -> tuple[int, list]:
+        async def request(offset: int, limit: int) -> httpx.Response:
+            page_data = {
+                "filters": {},
+                "sort": {
+                    "order": "DESC",
+                    "parameter": "MATCH_DATE",
+                    },
+                "limit": limit,
+                "offset": offset
+            }
+            return await self.dupr_post(f'/player/{self.version}/{member_id}/history',
+                                        page_data,
+                                        name="get_member_match_history")
+
+        async def fetch():
+            return await self.paged_fetch("history_p", request, 10, stop_when)
+        if stop_when:
+            # may stop early, so not a result to share with a full fetch
+            return await fetch()
+        return await self._coalesce(("get_member_match_history_p", str(member_id)), fetch)
+
+    async def get_members_by_club(self, club_id: str) -> tuple[int, list]:
+        async def request(offset: int, limit: int) -> httpx.Response:
+            data = {
+                "exclude": [],
+                "limit": limit,
+                "offset": offset,
+                "query": "*"
+                }
+            return await self.dupr_post(f'/club/{club_id}/members/v1.0/all',
+                                        json_data=data, name="get_member_by_club")
+
+        async def fetch():
+            return await self.paged_fetch("club_members", request, 20)
+        return await self._coalesce(("get_members_by_club", str(club_id)), fetch)
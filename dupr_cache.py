@@ -0,0 +1,147 @@
+"""
+    HTTP response cache for DuprClient.
+
+    Responses are stored in a small sqlite file keyed on method, url and
+    json body. Each call family (the "name" passed to dupr_get/dupr_post)
+    has its own TTL, a TTL of 0 means never cache it in normal use.
+
+    modes:
+        off     no caching
+        ttl     serve fresh enough responses from the cache (default)
+        record  always hit the network, store every successful response, and
+                client errors too, so a replay takes the same page size probes
+        replay  only serve from the cache, never hit the network
+
+    So a full crawl can be recorded once and replayed offline:
+
+        python duprly.py --record get-data
+        python duprly.py --replay --db test.sqlite get-data
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+from loguru import logger
+
+HOUR = 3600
+
+DEFAULT_TTLS = {
+    "get_player": 24 * HOUR,
+    "get_club": 24 * HOUR,
+    "get_profile": HOUR,
+    "get_member_by_club": HOUR,
+    "get_member_match_history": 0,
+}
+
+
+class ResponseCache(object):
+
+    MODES = ("off", "ttl", "record", "replay")
+    TRANSIENT = (401, 403, 408, 429)
+
+    def __init__(self, path: str = None, mode: str = "ttl", ttls: dict = None):
+        if mode not in self.MODES:
+            raise ValueError(f"unknown cache mode {mode}, use one of {', '.join(self.MODES)}")
+        self.path = path or os.getenv("DUPR_CACHE_PATH") or "dupr_cache.sqlite"
+        self.mode = mode
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.conn = None
+        if mode != "off":
+            self.conn = sqlite3.connect(self.path, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS response (
+                    key TEXT PRIMARY KEY,
+                    name TEXT,
+                    method TEXT,
+                    url TEXT,
+                    body TEXT,
+                    status INTEGER,
+                    content BLOB,
+                    fetched_at REAL
+                )""")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS page_limit (
+                    endpoint TEXT PRIMARY KEY,
+                    size INTEGER
+                )""")
+            self.conn.commit()
+
+    @staticmethod
+    def key(method: str, url: str, body=None) -> str:
+        b = json.dumps(body, sort_keys=True) if body is not None else ""
+        return hashlib.sha256(f"{method} {url} {b}".encode()).hexdigest()
+
+    def ttl(self, name: str) -> int:
+        return self.ttls.get(name, 0)
+
+    def lookup(self, method: str, url: str, body=None, name: str = "") -> Optional[tuple[int, bytes]]:
+        """ Cached (status, content) for this call, or None """
+        if self.mode in ("off", "record"):
+            return None
+        if self.mode == "ttl" and self.ttl(name) <= 0:
+            return None
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT status, content, fetched_at FROM response WHERE key = ?",
+                (self.key(method, url, body),)).fetchone()
+        if row and (self.mode == "replay" or time.time() - row[2] < self.ttl(name)):
+            self.hits += 1
+            logger.debug(f'cache hit: {name} : {url}')
+            return row[0], row[1]
+        self.misses += 1
+        if self.mode == "replay":
+            logger.warning(f'not in replay cache: {method} {url}')
+        return None
+
+    def store(self, method: str, url: str, body, name: str, status: int, content: bytes):
+        """ Store a response if the mode and TTL call for it """
+        if not self.storable(status):
+            return
+        if self.mode == "ttl" and self.ttl(name) <= 0:
+            return
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO response VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (self.key(method, url, body), name, method, url,
+                 json.dumps(body) if body is not None else None,
+                 status, content, time.time()))
+            self.conn.commit()
+
+    def page_limit(self, endpoint: str) -> Optional[int]:
+        """ Page size learnt for an endpoint in the recorded run, when replaying """
+        if self.mode != "replay":
+            return None
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT size FROM page_limit WHERE endpoint = ?", (endpoint,)).fetchone()
+        return row[0] if row else None
+
+    def store_page_limit(self, endpoint: str, size: int):
+        """ Keep a learnt page size with a recording, so replay asks for the same pages """
+        if self.mode != "record":
+            return
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO page_limit VALUES (?, ?)", (endpoint, size))
+            self.conn.commit()
+
+    def storable(self, status: int) -> bool:
+        if self.mode in ("off", "replay"):
+            return False
+        if self.mode == "record":
+            # a 400 for a too large page is part of the recorded crawl,
+            # auth failures and throttling are not
+            return status == 200 or (400 <= status < 500 and status not in self.TRANSIENT)
+        return status == 200
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
+            self.conn = None
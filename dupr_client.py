@@ -11,20 +11,97 @@
 
 """
 import os
+import base64
+import threading
+import time
 import requests
 from requests import Response
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from loguru import logger
 import json
-from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator, Optional
+
+from dupr_resources import loads
+
+
+class DuprTransport(object):
+    """
+    Pooled, keep-alive HTTP transport shared by all calls of a DuprClient.
+
+    A single requests.Session keeps TCP/TLS connections open between
+    calls, so paging through a history does not pay a handshake per page.
+    Connection errors and 5xx responses are retried with exponential
+    backoff. POST is included because the DUPR "search" style POST
+    calls (history, club members) are read only. Every call has a
+    timeout, so a stalled connection cannot hang a worker.
+    """
+
+    RETRY_STATUS = (500, 502, 503, 504)
+
+    def __init__(self, pool_size: int = 10, retries: int = 3, backoff: float = 0.5,
+                 timeout: float = 30.0):
+        self.pool_size = pool_size
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout  # seconds, connect and read
+        self.session = requests.Session()
+        self.session.headers.update({
+            'Accept-Encoding': 'gzip, deflate',
+            'Connection': 'keep-alive',
+        })
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=retries,
+            status=retries,
+            backoff_factor=backoff,
+            status_forcelist=self.RETRY_STATUS,
+            allowed_methods=frozenset(['GET', 'POST']),
+            raise_on_status=False,
+            # 429 is left to DuprClient.send and its rate limiter
+            respect_retry_after_header=False,
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size,
+                              max_retries=retry)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def request(self, method: str, url: str, **kwargs) -> Response:
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url: str, **kwargs) -> Response:
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> Response:
+        return self.request('POST', url, **kwargs)
+
+    def close(self):
+        self.session.close()
 
 
 class DuprClient(object):
 
-    def __init__(self, api_url: str = None, api_version: str = None, verbose: bool = False):
+    # page sizes to probe paged calls with, largest first
+    PROBE_LIMITS = (100, 50, 25, 10)
+    # log in again when the token has less than this many seconds left
+    TOKEN_MARGIN = 300
+    # times to wait and retry a request throttled with 429
+    THROTTLE_RETRIES = 5
+
+    def __init__(self, api_url: str = None, api_version: str = None, verbose: bool = False,
+                 pool_size: int = 10, retries: int = 3, backoff: float = 0.5, fan_out: int = 4,
+                 cache=None, archive=None, limiter=None, timeout: float = 30.0):
         self.env_path = os.path.expanduser('~/.duprly_config')
         logger.debug(self.env_path)
         if api_url:
             self.env_url = api_url
+        elif os.getenv("DUPR_API_URL"):
+            # e.g. the fake server in bench/
+            self.env_url = os.getenv("DUPR_API_URL")
         else:
             self.env_url = 'https://api.dupr.gg'
         if api_version:
@@ -33,8 +110,20 @@ class DuprClient(object):
             self.version = "v1.0"
         self.access_token = None
         self.refresh_token = None  # from login
+        self.username = None  # kept by auth_user to log in again on expiry
+        self.password = None
+        self.token_lock = threading.Lock()
         self.failed = False  # Strange way to return error, for now TBD
         self.verbose = verbose
+        self.transport = DuprTransport(pool_size=pool_size, retries=retries, backoff=backoff,
+                                       timeout=timeout)
+        self.fan_out = fan_out  # concurrent page requests per paged call
+        self.page_limits = {}  # endpoint -> largest page size it accepted
+        self.probe_locks = {}  # endpoint -> lock held while probing its page size
+        self.cache = cache  # optional dupr_cache.ResponseCache
+        self.archive = archive  # optional dupr_archive.RawArchive
+        self.limiter = limiter  # optional dupr_ratelimit.RateLimiter
+        self.metrics = None  # optional dupr_metrics.Metrics
         self.load_token()
 
     def load_token(self):
@@ -48,17 +137,61 @@ class DuprClient(object):
             pass
 
     def save_token(self):
-        """ Save  access token to disk, in plain json text
+        """ Save  access token to disk, in plain json text.
+            Written to a temp file and renamed, so concurrent runs never
+            read a half written token file.
         """
+        tmp = f"{self.env_path}.{os.getpid()}.tmp"
         try:
-            with open(self.env_path, "w") as f:
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as f:
                 data = {
                     'access_token': self.access_token
                 }
                 json.dump(data, f)
-        except FileNotFoundError:
+            os.replace(tmp, self.env_path)
+        except OSError:
             logger.debug(f"Cannot save token to {self.env_path}")
 
+    @staticmethod
+    def token_expiry(token: str) -> Optional[float]:
+        """ exp (epoch seconds) from the JWT payload, None if not a JWT """
+        try:
+            payload = token.split('.')[1]
+            payload += '=' * (-len(payload) % 4)
+            return float(json.loads(base64.urlsafe_b64decode(payload))['exp'])
+        except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+            return None
+
+    def token_expiring(self) -> bool:
+        """ True if there is no token, or it expires within TOKEN_MARGIN.
+            A token without a readable expiry is trusted until a 401/403.
+        """
+        if not self.access_token:
+            return True
+        exp = self.token_expiry(self.access_token)
+        return exp is not None and exp - time.time() < self.TOKEN_MARGIN
+
+    def ensure_token(self):
+        """ Log in again ahead of time if the token is about to expire """
+        if self.username and self.token_expiring():
+            self.refresh_user(self.access_token)
+
+    def refresh_user(self, stale_token: str = None) -> int:
+        """ Log in again with the saved credentials after the token
+            stale_token expired or was refused. Safe to call from many
+            workers at once: only the first one logs in, the others see
+            the token has changed and just use the new one.
+        """
+        with self.token_lock:
+            if self.access_token != stale_token and not self.token_expiring():
+                return 200
+            if not self.username:
+                logger.warning("token expired, no credentials to log in again")
+                return 401
+            logger.info("access token expired, logging in again")
+            return self.login_user(self.username, self.password)
+
     def u(self, parts):
         """ Helper function to construct URL """
         url = f'{self.env_url}{parts}'
@@ -90,7 +223,9 @@ class DuprClient(object):
             This API curently just use an access token.
             Not oauth style access/refresh token set.
         """
-        if self.access_token:
+        self.username = username
+        self.password = password
+        if self.access_token and not self.token_expiring():
             return 0
         else:
             rc = self.login_user(username, password)
@@ -103,7 +238,7 @@ class DuprClient(object):
             "password": password,
         }
         logger.debug(f'login user: {username}')
-        r = requests.post(self.u('/auth/v1.0/login/'), json=body)
+        r = self.transport.post(self.u('/auth/v1.0/login/'), json=body)
         logger.debug(f'login user: {r.status_code}')
         logger.debug(f'login user: {r.request.url}')
         if r.status_code == 200:
@@ -119,88 +254,292 @@ class DuprClient(object):
             'Authorization': f'Bearer {self.access_token}'
         }
 
-    def dupr_get(self, url, name: str = "") -> Response:
+    @staticmethod
+    def make_response(status: int, content: bytes, url: str) -> Response:
+        """ Build a Response for a cached (or missing) result """
+        r = Response()
+        r.status_code = status
+        r._content = content
+        r.url = url
+        r.encoding = 'utf-8'
+        r.headers['Content-Type'] = 'application/json'
+        return r
+
+    def cached_response(self, method: str, url: str, body, name: str,
+                        fresh: bool = False) -> Optional[Response]:
+        """ Response from the cache, or None to go to the network.
+            In replay mode a miss is a 504 instead. fresh skips the
+            cache, except when replaying.
+        """
+        if not self.cache or (fresh and self.cache.mode != "replay"):
+            return None
+        hit = self.cache.lookup(method, self.u(url), body, name)
+        if hit:
+            return self.make_response(hit[0], hit[1], self.u(url))
+        if self.cache.mode == "replay":
+            return self.make_response(504, b'', self.u(url))
+        return None
+
+    def cache_response(self, method: str, url: str, body, name: str, r: Response):
+        """ Keep a response fetched from the network in the cache and archive """
+        if self.cache:
+            self.cache.store(method, self.u(url), body, name, r.status_code, r.content)
+        if self.archive and r.status_code == 200:
+            self.archive.write(name, method, self.u(url), body, r.content)
+
+    def send(self, method: str, url: str, name: str, **kwargs) -> Response:
+        """ One request through the rate limiter, if there is one.
+            A 429 is retried once the limiter lets the call family go again.
+        """
+        for attempt in range(self.THROTTLE_RETRIES + 1):
+            if self.limiter:
+                self.limiter.acquire(name)
+            t0 = time.perf_counter()
+            r = self.transport.request(method, self.u(url), headers=self.headers(), **kwargs)
+            if self.metrics:
+                # retries done by urllib3 inside this one call, and ours after a 429
+                retries = len(r.raw.retries.history) if r.raw.retries else 0
+                self.metrics.request(name, r.status_code, time.perf_counter() - t0,
+                                     len(r.content), retries + (attempt > 0))
+            if not self.limiter:
+                break
+            self.limiter.feedback(name, r.status_code, r.headers.get('Retry-After'))
+            if r.status_code != 429:
+                break
+        return r
+
+    def dupr_get(self, url, name: str = "", fresh: bool = False) -> Response:
+        r = self.cached_response('GET', url, None, name, fresh)
+        if r is not None:
+            return r
         logger.debug(f'GET: {name} : {url}')
-        r = requests.get(self.u(url), headers=self.headers())
+        self.ensure_token()
+        token = self.access_token
+        r = self.send('GET', url, name)
         logger.debug(f'return: {r.status_code}')
-        if r.status_code == 403:
-            rc = self.refresh_user()
+        if r.status_code in (401, 403):
+            rc = self.refresh_user(token)
             if rc == 200:
                 logger.debug(f'GET: {url}')
-                r = requests.get(self.u(url), headers=self.headers())
+                r = self.send('GET', url, name)
                 logger.debug(f'return: {r.status_code}')
         self.failed = r.status_code != 200
+        self.cache_response('GET', url, None, name, r)
         return r
 
     def dupr_post(self, url, json_data=None, name: str = "") -> Response:
+        r = self.cached_response('POST', url, json_data, name)
+        if r is not None:
+            return r
         logger.debug(f'POST: {name} : {url}')
-        headers = self.headers()
-        r = requests.post(self.u(url), headers=headers,  json=json_data)
+        self.ensure_token()
+        token = self.access_token
+        r = self.send('POST', url, name, json=json_data)
         logger.debug(f'return: {r.status_code}')
-        if r.status_code == 403:
-            rc = self.refresh_user()
+        if r.status_code in (401, 403):
+            rc = self.refresh_user(token)
             if rc == 200:
                 logger.debug(f'POST: {url}')
-                r = requests.post(self.u(url), headers=self.headers())
+                r = self.send('POST', url, name, json=json_data)
                 logger.debug(f'return: {r.status_code}')
         self.failed = r.status_code != 200
+        self.cache_response('POST', url, json_data, name, r)
         return r
 
     def get_profile(self) -> tuple[int, dict]:
         r = self.dupr_get(f'/user/{self.version}/profile/', "get_profile")
         if r.status_code == 200:
-            self.ppj(r.json())
-            return r.status_code, r.json()["result"]
+            data = loads(r.content)
+            self.ppj(data)
+            return r.status_code, data["result"]
         return r.status_code, None
 
-    def get_player(self, player_id: str) -> tuple[int, Optional[dict]]:
-        r = self.dupr_get(f'/player/{self.version}/{player_id}', "get_player")
+    def get_player(self, player_id: str, fresh: bool = False) -> tuple[int, Optional[dict]]:
+        """ Player json. fresh asks the API even if the player is cached,
+            for callers that record the time the rating was fetched.
+        """
+        r = self.dupr_get(f'/player/{self.version}/{player_id}', "get_player", fresh)
         if r.status_code == 200:
-            self.ppj(r.json())
-            return r.status_code, r.json()["result"]
+            data = loads(r.content)
+            self.ppj(data)
+            return r.status_code, data["result"]
         else:
             return r.status_code, None
 
     def get_club(self, club_id: str):
         r = self.dupr_get(f'/club/{self.version}/{club_id}', "get_club")
         if r.status_code == 200:
-            self.ppj(r.json())
+            self.ppj(loads(r.content))
         return r.status_code
 
-    def get_member_match_history_p(self, member_id: str) -> tuple[int, list]:
-        page_data = {
-            "filters": {},
-            "sort": {
-                "order": "DESC",
-                "parameter": "MATCH_DATE",
-                },
-            "limit": 10,
-            "offset": 0
-        }
-        offset = 0
-        hit_data = []
-        while offset is not None:
-            r = self.dupr_post(f'/player/{self.version}/{member_id}/history',
-                               page_data,
-                               name="get_member_match_history")
-            if r.status_code == 200:
-                offset, hits = self.handle_paging(r.json())
-                hit_data.extend(hits)
-                page_data["offset"] = offset
-        self.ppj(page_data)
-        return r.status_code, hit_data
+    def page_limit(self, endpoint: str) -> int:
+        """ Page size to ask for: the one this endpoint took so far
+            (or in the recorded run being replayed), or the largest
+            candidate to probe with.
+        """
+        if endpoint not in self.page_limits and self.cache:
+            recorded = self.cache.page_limit(endpoint)
+            if recorded and recorded > 0:
+                self.page_limits[endpoint] = recorded
+        return self.page_limits.get(endpoint, self.PROBE_LIMITS[0])
+
+    def smaller_page_limit(self, limit: int, default: int) -> Optional[int]:
+        """ Next page size to probe with after limit was rejected """
+        smaller = [x for x in self.PROBE_LIMITS + (default,) if x < limit]
+        return max(smaller) if smaller else None
+
+    def retry_page_limit(self, endpoint: str, limit: int, default: int) -> Optional[int]:
+        """ Page size to ask for again after a 400 at limit, None to give up.
+            Another worker may have learnt the endpoint's size while this
+            probe was in flight, then that is used. A 400 at the learnt
+            size itself is a real error.
+        """
+        learnt = self.page_limits.get(endpoint)
+        if learnt is not None:
+            return learnt if learnt != limit else None
+        return self.smaller_page_limit(limit, default)
+
+    def learn_page_limit(self, endpoint: str, asked: int, json_data: dict) -> int:
+        """ Remember the page size the endpoint actually returned.
+            The API may echo a smaller limit, or just return fewer hits.
+            An empty page says nothing about the size, asked is kept.
+        """
+        result = json_data["result"]
+        got = result.get("limit") or asked
+        n = len(result["hits"])
+        if 0 < n < got and result["offset"] + n < result["total"]:
+            got = n
+        limit = max(1, min(asked, got))
+        if self.page_limits.get(endpoint) != limit:
+            logger.debug(f"page limit for {endpoint}: {limit}")
+            if self.cache:
+                self.cache.store_page_limit(endpoint, limit)
+        self.page_limits[endpoint] = limit
+        return limit
+
+    def first_page(self, endpoint: str, request: Callable[[int, int], Response],
+                   default_limit: int = 10) -> tuple[Response, Optional[dict], int]:
+        """ The first page of a paged call: response, json (None unless 200)
+            and the page size to go on with. Until an endpoint's page size
+            is learnt one thread at a time probes it, the others then ask
+            at the learnt size instead of all probing at the largest.
+        """
+        self.page_limit(endpoint)
+        if endpoint in self.page_limits:
+            return self._first_page(endpoint, request, default_limit)
+        with self.probe_locks.setdefault(endpoint, threading.Lock()):
+            return self._first_page(endpoint, request, default_limit)
+
+    def _first_page(self, endpoint: str, request: Callable[[int, int], Response],
+                    default_limit: int) -> tuple[Response, Optional[dict], int]:
+        limit = self.page_limit(endpoint)
+        while True:
+            r = request(0, limit)
+            if r.status_code != 400:
+                break
+            limit = self.retry_page_limit(endpoint, limit, default_limit)
+            if not limit:
+                break
+        if r.status_code != 200:
+            return r, None, limit
+        json_data = loads(r.content)
+        return r, json_data, self.learn_page_limit(endpoint, limit, json_data)
+
+    def pages(self, endpoint: str, request: Callable[[int, int], Response],
+              default_limit: int = 10) -> "Pages":
+        """ Pages of a paged call, fetched one by one as they are iterated """
+        return Pages(self, endpoint, request, default_limit)
+
+    def paged_fetch(self, endpoint: str, request: Callable[[int, int], Response],
+                    default_limit: int = 10,
+                    stop_when: Callable[[list], bool] = None) -> tuple[int, list]:
+        """
+        Fetch all hits of a paged call.
+
+        request(offset, limit) makes one page call. The first page is used
+        to learn the total and the accepted page size (probing down from
+        the largest candidate if the call is rejected), the remaining
+        offsets are then fetched concurrently, up to self.fan_out at a time.
+        With stop_when, pages are fetched one by one, newest first, until
+        stop_when(hits) is True.
+        """
+        pages = self.pages(endpoint, request, default_limit)
+        it = iter(pages)
+        hit_data = list(next(it, []))
+        if pages.status != 200:
+            return pages.status, []
+        if stop_when or self.fan_out <= 1 or not hit_data or pages.next_offset >= pages.total:
+            if not (stop_when and stop_when(hit_data)):
+                for hits in it:
+                    hit_data.extend(hits)
+                    if stop_when and stop_when(hits):
+                        logger.debug(f"stop paging {endpoint} at {pages.next_offset}")
+                        break
+            return pages.status, hit_data
+
+        offsets = list(range(pages.next_offset, pages.total, pages.limit))
+        with ThreadPoolExecutor(max_workers=self.fan_out) as pool:
+            responses = list(pool.map(lambda o: request(o, pages.limit), offsets))
+        for r in responses:
+            if r.status_code != 200:
+                return r.status_code, hit_data
+            hit_data.extend(loads(r.content)["result"]["hits"])
+        return 200, hit_data
+
+    def history_p_request(self, member_id: str) -> Callable[[int, int], Response]:
+        def request(offset: int, limit: int) -> Response:
+            page_data = {
+                "filters": {},
+                "sort": {
+                    "order": "DESC",
+                    "parameter": "MATCH_DATE",
+                    },
+                "limit": limit,
+                "offset": offset
+            }
+            return self.dupr_post(f'/player/{self.version}/{member_id}/history',
+                                  page_data,
+                                  name="get_member_match_history")
+        return request
+
+    def history_request(self, member_id: str) -> Callable[[int, int], Response]:
+        def request(offset: int, limit: int) -> Response:
+            return self.dupr_get(
+                f'/player/{self.version}/{member_id}/history?limit={limit}&offset={offset}',
+                name="get_member_match_history")
+        return request
+
+    def club_members_request(self, club_id: str) -> Callable[[int, int], Response]:
+        def request(offset: int, limit: int) -> Response:
+            data = {
+                "exclude": [],
+                "limit": limit,
+                "offset": offset,
+                "query": "*"
+                }
+            return self.dupr_post(f'/club/{club_id}/members/v1.0/all', json_data=data,
+                                  name="get_member_by_club")
+        return request
+
+    def get_member_match_history_p(self, member_id: str,
+                                   stop_when: Callable[[list], bool] = None) -> tuple[int, list]:
+        """
+        Get all match history, newest first.
+        If stop_when(hits) returns True for a page, stop paging after it.
+        """
+        return self.paged_fetch("history_p", self.history_p_request(member_id), 10, stop_when)
+
+    def iter_member_match_history_p(self, member_id: str) -> "Pages":
+        """ Match history pages, newest first, fetched as they are iterated """
+        return self.pages("history_p", self.history_p_request(member_id), 10)
 
     def get_member_match_history(self, member_id: str) -> tuple[int, list]:
-        offset = 0
-        hit_data = []
-        while offset is not None:
-            r = self.dupr_get(f'/player/{self.version}/{member_id}/history?limit=100&offset={offset}',
-                              name="get_member_match_history")
-            if r.status_code == 200:
-                offset, hits = self.handle_paging(r.json())
-                hit_data.extend(hits)
+        rc, hit_data = self.paged_fetch("history", self.history_request(member_id), 100)
         self.ppj(hit_data)
-        return r.status_code, hit_data
+        return rc, hit_data
+
+    def iter_member_match_history(self, member_id: str) -> "Pages":
+        return self.pages("history", self.history_request(member_id), 100)
 
     def handle_paging(self, json_data):
         """
@@ -227,20 +566,67 @@ class DuprClient(object):
         """
         this call is a post call because it supports query and filter.
         """
-        data = {
-            "exclude": [],
-            "limit": 20,
-            "offset": 0,
-            "query": "*"
-            }
-        offset = 0
-        pdata = []
-        while (offset is not None):
-            data["offset"] = offset
-            r = self.dupr_post(f'/club/{club_id}/members/v1.0/all', json_data=data, name="get_member_by_club")
-            if r.status_code == 200:
-                self.ppj(r.json())
-                offset, hits = self.handle_paging(r.json())
-                pdata.extend(hits)
-
-        return r.status_code, pdata
+        return self.paged_fetch("club_members", self.club_members_request(club_id), 20)
+
+    def iter_members_by_club(self, club_id: str) -> "Pages":
+        return self.pages("club_members", self.club_members_request(club_id), 20)
+
+
+class Pages(object):
+    """
+    The pages of a paged call, fetched one at a time as they are iterated,
+    so a caller can save each page before asking for the next and never
+    holds more than one page:
+
+        pages = dupr.iter_member_match_history_p(dupr_id)
+        for hits in pages:
+            save(hits)
+        if pages.status != 200:
+            ...
+
+    Iteration stops at the last page or at the first failed request;
+    status then holds 200 or the failing status code. The first request
+    learns the page size the endpoint takes, as in DuprClient.paged_fetch.
+    """
+
+    def __init__(self, client: DuprClient, endpoint: str,
+                 request: Callable[[int, int], Response], default_limit: int = 10):
+        self.client = client
+        self.endpoint = endpoint
+        self.request = request
+        self.default_limit = default_limit
+        self.status = None
+        self.total = None
+        self.limit = None
+        self.next_offset = 0
+
+    def __iter__(self) -> Iterator[list]:
+        r, json_data, self.limit = self.client.first_page(
+            self.endpoint, self.request, self.default_limit)
+        self.status = r.status_code
+        if r.status_code != 200:
+            return
+
+        self.total = json_data["result"]["total"]
+        hits = json_data["result"]["hits"]
+        self.next_offset = len(hits)
+        yield hits
+        if not hits:
+            # no first page, whatever the total says
+            return
+        # offsets come from the first page's total, so a short or empty
+        # page cannot keep the loop going
+        for offset in range(self.next_offset, self.total, self.limit):
+            r = self.request(offset, self.limit)
+            self.status = r.status_code
+            if r.status_code != 200:
+                logger.warning(f"{self.endpoint} page at {offset} failed: {r.status_code}")
+                return
+            hits = loads(r.content)["result"]["hits"]
+            self.next_offset = offset + len(hits)
+            yield hits
+
+    def hits(self) -> Iterator[dict]:
+        """ The hits of all pages, one by one """
+        for hits in self:
+            yield from hits
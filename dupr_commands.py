@@ -0,0 +1,530 @@
+"""
+    The work behind the duprly commands.
+
+    duprly.py only parses the command line, and imports this module when a
+    command actually runs. The DUPR client and the database engine are made
+    on first use with the options of the cli group (see configure()), so a
+    command that never touches the API does not read the token file and one
+    that never touches the database does not open it.
+"""
+import asyncio
+import atexit
+import json
+import os
+import re
+from datetime import date, datetime, time
+from typing import Optional
+
+import click
+from loguru import logger
+from sqlalchemy import select, func
+from sqlalchemy.orm import Session
+
+from dupr_client import DuprClient
+from dupr_cache import ResponseCache
+from dupr_archive import RawArchive
+from dupr_ratelimit import RateLimiter
+from dupr_metrics import Metrics
+from dupr_config import CRAWL_BATCH, RATING_BUDGET
+from dupr_resources import Player as PlayerRecord, decode_matches, decode_players
+from dupr_db import open_db, Player, Match, Rating, MatchDetail, PlayerSync
+from dupr_db import SyncIdentityMap, ClubMember, report_players, report_matches
+from dupr_db import PlayerSummary, PlayerRelation, CrawlFrontier, ratings_to_refresh
+from dupr_db import rating_as_of, rating_change
+
+# cli group options, see configure()
+options = {
+    "db": None,
+    "db_profile": None,
+    "cache_mode": "ttl",
+    "archive_dir": None,
+    "archive": True,
+    "rate_limit": True,
+}
+metrics = Metrics()
+_configured = False
+_dupr = None
+_eng = None
+
+
+def configure(**kwargs):
+    """ Take the cli group options, once per run """
+    global _configured
+    if _configured:
+        return
+    _configured = True
+    options.update(kwargs)
+    logger.add("duprly_{time}.log")
+
+
+def client() -> DuprClient:
+    """ The DUPR client, made on first use """
+    global _dupr
+    if _dupr is None:
+        _dupr = DuprClient()
+        _dupr.cache = ResponseCache(mode=options["cache_mode"])
+        if options["archive"] and options["cache_mode"] != "replay":
+            _dupr.archive = RawArchive(options["archive_dir"])
+            atexit.register(_dupr.archive.close)
+        if options["rate_limit"]:
+            _dupr.limiter = RateLimiter()
+        _dupr.metrics = metrics
+    return _dupr
+
+
+def engine():
+    """ The database engine, opened on first use """
+    global _eng
+    if _eng is None:
+        try:
+            _eng = open_db(options["db"], options["db_profile"])
+        except ValueError as e:
+            raise click.ClickException(str(e))
+        metrics.watch_engine(_eng)
+    return _eng
+
+
+def report_metrics(json_path: str = None, prom_path: str = None):
+    """ Summary of the run, at the end of every command """
+    extra = {}
+    if _dupr and _dupr.cache.mode != "off":
+        extra.update(cache_hits=_dupr.cache.hits, cache_misses=_dupr.cache.misses)
+    if _dupr and _dupr.limiter:
+        extra.update(throttled=_dupr.limiter.throttled)
+    if _dupr and _dupr.archive:
+        extra.update(archived=_dupr.archive.written)
+    metrics.summary(extra)
+    if json_path:
+        metrics.write_json(json_path, extra)
+    if prom_path:
+        metrics.write_prometheus(prom_path, extra)
+
+
+def ppj(data):
+    logger.debug(json.dumps(data, indent=4))
+
+
+def dupr_auth():
+    if client().cache.mode == "replay":
+        return  # offline
+    username = os.getenv("DUPR_USERNAME")
+    password = os.getenv("DUPR_PASSWORD")
+    client().auth_user(username, password)
+
+
+def get_player_from_dupr(pid: int) -> Optional[PlayerRecord]:
+
+    rc, pdata = client().get_player(pid, fresh=True)
+    logger.debug(f"dupr.get_player for id {pid} GET...")
+    ppj(pdata)
+    if rc != 200:
+        logger.warning(f"could not fetch player {pid}: {rc}")
+        return None
+
+    player = PlayerRecord.from_json(pdata)
+    logger.debug(player)
+    with Session(engine()) as sess:
+        Player.bulk_upsert(sess, [player])
+        sess.commit()
+
+    return player
+
+
+def get_all_players_from_dupr() -> list:
+    """ Save the club members a page at a time, return their DUPR ids """
+    club_id = os.getenv("DUPR_CLUB_ID")
+    dupr_ids = []
+    for hits in client().iter_members_by_club(club_id):
+        members = decode_players(hits)
+        with Session(engine()) as sess:
+            Player.bulk_upsert(sess, members)
+            ClubMember.add_members(sess, club_id, members)
+            sess.commit()
+        dupr_ids += [p.dupr_id for p in members]
+    logger.info(f"saved {len(dupr_ids)} club members")
+    return dupr_ids
+
+
+def get_matches_from_dupr(dupr_id: int, incremental: bool = False, idmap: SyncIdentityMap = None,
+                          max_depth: int = None):
+    """ Get match history for specified player, saving each page as it
+        arrives. The sync watermark and the crawl frontier state are only
+        written once the whole history is in, so a player interrupted half
+        way is fetched again (and its saved matches skipped) next time.
+    """
+    if idmap is None:
+        idmap = SyncIdentityMap()
+    stop_when = history_stop_when(dupr_id, incremental)
+    pages = client().iter_member_match_history_p(dupr_id)
+    newest = []
+    n = 0
+    for hits in pages:
+        # before saving, or every match of the page is known
+        stop = stop_when and stop_when(hits)
+        matches = decode_matches(hits)
+        with Session(engine()) as sess:
+            n += idmap.add_matches(sess, matches)
+            if max_depth is not None:
+                CrawlFrontier.enqueue_met(sess, dupr_id, matches, max_depth)
+            sess.commit()
+        newest = newest or matches[:1]
+        if stop:
+            logger.debug(f"stop paging history of {dupr_id} at {pages.next_offset}")
+            break
+    with Session(engine()) as sess:
+        if pages.status == 200:
+            PlayerSync.mark(sess, dupr_id, newest)
+        if max_depth is not None:
+            if pages.status == 200:
+                CrawlFrontier.done(sess, dupr_id, [], max_depth)
+            else:
+                CrawlFrontier.failed(sess, dupr_id)
+        sess.commit()
+    logger.debug(f"saved {n} new matches of {dupr_id}")
+
+
+def history_stop_when(dupr_id: int, incremental: bool):
+    """ For incremental sync of a player that has been fully synced before,
+        return a check that stops paging at a page of only known matches.
+    """
+    if not incremental:
+        return None
+    with Session(engine()) as sess:
+        if not PlayerSync.get(sess, dupr_id):
+            return None
+
+    def stop_when(hits: list) -> bool:
+        with Session(engine()) as sess:
+            known = Match.known_ids(sess, [h.get("matchId") for h in hits])
+        return len(known) == len(hits)
+
+    return stop_when
+
+
+def write_matches(sess: Session, item: tuple, idmap: SyncIdentityMap, max_depth: int = None) -> int:
+    """ Add a fetched match history (dupr_id, rc, json hits) to the session,
+        with the sync watermark if it was fetched in full. When crawling
+        (max_depth given) the player is also marked done in the frontier,
+        in the same transaction. Caller commits.
+    """
+    dupr_id, rc, hits = item
+    matches = decode_matches(hits)
+    n = idmap.add_matches(sess, matches)
+    if rc == 200:
+        PlayerSync.mark(sess, dupr_id, matches)
+    if max_depth is not None:
+        if rc == 200:
+            CrawlFrontier.done(sess, dupr_id, matches, max_depth)
+        else:
+            CrawlFrontier.failed(sess, dupr_id)
+    return n
+
+
+def save_matches(item: tuple, idmap: SyncIdentityMap = None, max_depth: int = None):
+    """ Save one fetched match history (dupr_id, rc, json hits) and commit """
+
+    with Session(engine()) as sess:
+        if idmap is None:
+            idmap = SyncIdentityMap()
+        n = write_matches(sess, item, idmap, max_depth)
+        logger.debug(f"saved {n} new of {len(item[2])} matches")
+        sess.commit()
+
+
+def load_identity_map() -> SyncIdentityMap:
+    with Session(engine()) as sess:
+        return SyncIdentityMap().preload(sess)
+
+
+def update_ratings_from_dupr(budget: int = RATING_BUDGET, concurrency: int = 4, max_age: int = 30):
+    """ Fetch the player ratings most worth refreshing, up to budget requests:
+        limited data players first, then stale ratings of recently active players.
+    """
+    with Session(engine()) as sess:
+        dupr_ids = ratings_to_refresh(sess, budget, max_age)
+    logger.info(f"refreshing {len(dupr_ids)} player ratings")
+    if concurrency > 1:
+        asyncio.run(get_players_async(dupr_ids, concurrency))
+    else:
+        for i in dupr_ids:
+            save_players([(i, *client().get_player(i, fresh=True))])
+
+
+def save_players(results: list):
+    """ Save fetched players, results are (dupr_id, rc, player json) """
+    with Session(engine()) as sess:
+        Player.bulk_upsert(sess, decode_players([p for _i, rc, p in results if rc == 200]))
+        failed = [i for i, rc, _p in results if rc != 200]
+        if failed:
+            logger.warning(f"could not fetch players {failed}")
+        # players the API does not have wait max_age days, the others
+        # (5xx, throttled, replay misses) are tried again next run
+        gone = [i for i, rc, _p in results if rc in (404, 410)]
+        if gone:
+            Rating.touch(sess, gone)
+        sess.commit()
+
+
+async def get_players_async(dupr_ids: list, concurrency: int, batch: int = 100):
+    """ Fetch players concurrently, save them a batch at a time """
+    from dupr_async_client import AsyncDuprClient
+
+    async with AsyncDuprClient(client(), concurrency=concurrency) as adupr:
+
+        async def fetch(dupr_id):
+            return (dupr_id, *await adupr.get_player(dupr_id, fresh=True))
+
+        for i in range(0, len(dupr_ids), batch):
+            save_players(await asyncio.gather(*[fetch(d) for d in dupr_ids[i:i + batch]]))
+
+
+def update_match_detail(incremental: bool = False):
+    """ Flatten match data into match_detail """
+    with Session(engine()) as sess:
+        n = MatchDetail.build(sess, incremental)
+        sess.commit()
+    logger.info(f"match detail: {n} rows added")
+
+
+def update_player_summary(player_ids=None):
+    """ Refresh player_summary and player_relation, all or some players """
+    with Session(engine()) as sess:
+        n = PlayerSummary.refresh(sess, player_ids)
+        r = PlayerRelation.refresh(sess, player_ids)
+        sess.commit()
+    logger.info(f"player summary: {n} players, {r} partner/opponent rows")
+
+
+async def get_all_matches_async(dupr_ids: list, concurrency: int, incremental: bool,
+                                idmap: SyncIdentityMap, max_depth: int = None):
+    """ Fetch match histories concurrently, save each one as it arrives.
+        DB writes stay on this one thread.
+    """
+    from dupr_async_client import AsyncDuprClient
+
+    async with AsyncDuprClient(client(), concurrency=concurrency) as adupr:
+
+        async def fetch(dupr_id):
+            rc, matches = await adupr.get_member_match_history_p(
+                dupr_id, stop_when=history_stop_when(dupr_id, incremental))
+            return dupr_id, rc, matches
+
+        for task in asyncio.as_completed([fetch(i) for i in dupr_ids]):
+            save_matches(await task, idmap, max_depth)
+
+
+def get_all_matches_pipelined(dupr_ids: list, workers: int, batch_size: int, batch_seconds: float,
+                              incremental: bool, idmap: SyncIdentityMap, max_depth: int = None):
+    """ Fetch histories on worker threads, one writer thread commits in batches """
+    from dupr_pipeline import FetchWritePipeline
+
+    def fetch(dupr_id):
+        rc, matches = client().get_member_match_history_p(
+            dupr_id, stop_when=history_stop_when(dupr_id, incremental))
+        return dupr_id, rc, matches
+
+    def write(sess, item):
+        return write_matches(sess, item, idmap, max_depth)
+
+    def fail(sess, dupr_id):
+        if max_depth is not None:
+            CrawlFrontier.failed(sess, dupr_id)
+
+    pipeline = FetchWritePipeline(engine(), fetch, write,
+                                  workers=workers,
+                                  batch_size=batch_size,
+                                  batch_seconds=batch_seconds,
+                                  fail=fail)
+    pipeline.run(dupr_ids)
+
+
+def get_data(concurrency: int = 1, pipeline: bool = False, workers: int = 4, batch_size: int = 500,
+             batch_seconds: float = 2.0, incremental: bool = False, max_depth: int = 1,
+             resume: bool = False, rating_budget: int = RATING_BUDGET):
+    """ Crawl the club and the players met in its matches, then refresh
+        match detail, the player summary and ratings.
+    """
+    logger.info("Getting data from DUPR...")
+    dupr_auth()
+    with Session(engine()) as sess:
+        if resume:
+            CrawlFrontier.resume(sess)
+            if not CrawlFrontier.counts(sess).get(CrawlFrontier.QUEUED):
+                logger.info("no interrupted crawl to resume, starting a new one")
+                resume = False
+        if not resume:
+            CrawlFrontier.clear(sess)
+        sess.commit()
+    if not resume:
+        members = get_all_players_from_dupr()
+        with Session(engine()) as sess:
+            CrawlFrontier.enqueue(sess, members, 0)
+            sess.commit()
+    idmap = load_identity_map()
+
+    while True:
+        with Session(engine()) as sess:
+            dupr_ids = list(CrawlFrontier.claim(sess, CRAWL_BATCH))
+            sess.commit()
+        if not dupr_ids:
+            break
+        if pipeline:
+            get_all_matches_pipelined(dupr_ids, workers, batch_size, batch_seconds, incremental,
+                                      idmap, max_depth)
+        elif concurrency > 1:
+            asyncio.run(get_all_matches_async(dupr_ids, concurrency, incremental, idmap, max_depth))
+        else:
+            for i in dupr_ids:
+                get_matches_from_dupr(i, incremental, idmap, max_depth)
+    with Session(engine()) as sess:
+        logger.info(f"crawl: {CrawlFrontier.counts(sess)}")
+
+    update_match_detail(incremental=True)
+    # a resumed run does not know what the interrupted one touched
+    update_player_summary(None if resume else idmap.touched)
+    # after the summary, so new matches count as recent activity
+    update_ratings_from_dupr(rating_budget, max(concurrency, 4))
+
+
+def rebuild_db_from_archive(archive: RawArchive):
+    """ Load archived raw responses into the (empty) database,
+        in crawl order: club members, match histories, then players.
+    """
+    with Session(engine()) as sess:
+        if sess.scalar(select(func.count(Player.id))):
+            raise click.ClickException("database is not empty, use --db to give a new one")
+
+    with Session(engine()) as sess:
+        n = 0
+        for rec in archive.records("get_member_by_club"):
+            members = decode_players(rec["response"]["result"]["hits"])
+            n += Player.bulk_upsert(sess, members, fetched_at=datetime.fromtimestamp(rec["fetched_at"]))
+            m = re.search(r"/club/([^/]+)/members", rec["url"])
+            if m:
+                ClubMember.add_members(sess, m.group(1), members)
+        sess.commit()
+        logger.info(f"rebuild: {n} club members")
+
+        idmap = SyncIdentityMap().preload(sess)
+        n = 0
+        for i, rec in enumerate(archive.records("get_member_match_history")):
+            n += idmap.add_matches(sess, decode_matches(rec["response"]["result"]["hits"]))
+            if i % 1000 == 999:
+                sess.commit()
+        sess.commit()
+        logger.info(f"rebuild: {n} matches")
+
+        n = 0
+        for rec in archive.records("get_player"):
+            n += Player.bulk_upsert(sess, decode_players([rec["response"]["result"]]),
+                                    fetched_at=datetime.fromtimestamp(rec["fetched_at"]))
+        sess.commit()
+        logger.info(f"rebuild: {n} player profiles")
+
+    update_match_detail()
+    update_player_summary()
+
+
+def rebuild_db():
+    archive = RawArchive(options["archive_dir"])
+    logger.info(f"Rebuilding database from {archive.path}...")
+    rebuild_db_from_archive(archive)
+
+
+def write_excel(output: str, since: str = None, until: str = None, club: str = None):
+    """ Stream the players and match report into a write-only workbook,
+        so memory use does not grow with the number of matches.
+    """
+    from openpyxl import Workbook
+    from openpyxl.styles import numbers
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("players")
+    ws.column_dimensions['A'].number_format = u'#,##0'
+    ws.append(("id", "DUPR id", "full name", "gender", "age") +
+              ("single", "single verified", "single provisional") +
+              ("double", "double verified", "double provisional")
+              )
+
+    with Session(engine()) as sess:
+        q = report_players(club).execution_options(yield_per=1000)
+        for row in sess.execute(q):
+            ws.append(tuple(row))
+
+        ws = wb.create_sheet("matches")
+        ws.column_dimensions['A'].number_format = u'#,##0'
+        ws.column_dimensions['G'].number_format = numbers.FORMAT_TEXT
+        prow = ("player1 DUPR ID", "player 1", "player1 doubles",
+                "player2 DUPR ID", "player 2", "player2 doubles")
+        ws.append(("match id", "event", "event date", "match type", "source") +
+                  ("score1",) + prow + ("score2",) + prow)
+        n = 0
+        q = report_matches(since, until, club).execution_options(yield_per=1000)
+        for row in sess.execute(q):
+            ws.append(tuple(row))
+            n += 1
+
+    wb.save(filename=output)
+    logger.info(f"wrote {n} matches to {output}")
+
+
+def export(tables: tuple, fmt: str, output: str, since: str = None, batch_size: int = 10000):
+    from dupr_export import export_table
+
+    with Session(engine()) as sess:
+        for name in tables:
+            path = output
+            if len(tables) > 1:
+                os.makedirs(output, exist_ok=True)
+                path = os.path.join(output, f"{name}.{fmt}")
+            export_table(sess, name, fmt, path, since, batch_size)
+
+
+def end_of(day: str) -> datetime:
+    """ A YYYY-MM-DD date means the end of that day, a full timestamp is used as is """
+    if len(day) <= 10:
+        return datetime.combine(date.fromisoformat(day), time.max)
+    return datetime.fromisoformat(day)
+
+
+def echo_rows(header: tuple, rows):
+    click.echo("\t".join(header))
+    for row in rows:
+        click.echo("\t".join("" if v is None else str(v) for v in row))
+
+
+def show_rating_as_of(when: str, dupr_ids: tuple = (), club: str = None):
+    with Session(engine()) as sess:
+        echo_rows(("dupr id", "name", "observed at", "doubles", "doubles verified",
+                   "doubles provisional", "singles", "singles verified", "singles provisional"),
+                  sess.execute(rating_as_of(end_of(when), list(dupr_ids), club)))
+
+
+def show_rating_change(start: str, end: str, dupr_ids: tuple = (), club: str = None):
+    with Session(engine()) as sess:
+        echo_rows(("dupr id", "name", "doubles start", "doubles end", "doubles change",
+                   "singles start", "singles end", "singles change"),
+                  sess.execute(rating_change(end_of(start), end_of(end), list(dupr_ids), club)))
+
+
+def analyze(scale: float, upset_threshold: float):
+    import dupr_analytics
+
+    with Session(engine()) as sess:
+        dupr_analytics.analyze(sess, scale, upset_threshold)
+        sess.commit()
+
+
+def test_db():
+    dupr_auth()
+    club_id = os.getenv("DUPR_CLUB_ID")
+    _rc, players = client().get_members_by_club(club_id)
+    return
+    with Session(engine()) as sess:
+        # Has to use "has" not "any" because it is 1=1? Also need to have something
+        # in the has() function
+        # use sess.scalars instead of execute(...).scalars() for more concise use
+        dupr_ids = sess.scalars(select(Player.dupr_id).where(
+            ~Player.rating.has(Rating.doubles)))
+    for i in dupr_ids:
+        print(i)
@@ -0,0 +1,40 @@
+"""
+    Settings that the command line needs before any heavy import:
+    database path and storage profiles, export names and run defaults.
+"""
+import os
+
+DEFAULT_DB_PATH = "dupr.sqlite"
+
+# Storage profiles: pragmas applied on every new SQLite connection.
+# "fast" uses WAL so readers (datasette) do not block the sync writer,
+# and relaxes fsync to once per checkpoint instead of every commit.
+DB_PROFILES = {
+    "default": {},
+    "fast": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -65536,  # KiB, so 64MB
+        "mmap_size": 268435456,
+        "temp_store": "MEMORY",
+    },
+}
+
+EXPORT_TABLES = ("player", "rating", "match", "match_detail")
+EXPORT_FORMATS = ("csv", "ndjson", "parquet")
+
+# players claimed from the crawl frontier at a time
+CRAWL_BATCH = 200
+# player rating requests per run
+RATING_BUDGET = 1000
+
+
+def db_config(path: str = None, profile: str = None) -> tuple[str, str]:
+    """ DB path and storage profile: arguments, then the DUPR_DB_PATH and
+        DUPR_DB_PROFILE env vars, then defaults.
+    """
+    path = path or os.getenv("DUPR_DB_PATH") or DEFAULT_DB_PATH
+    profile = profile or os.getenv("DUPR_DB_PROFILE") or "default"
+    if profile not in DB_PROFILES:
+        raise ValueError(f"unknown db profile {profile}, use one of {', '.join(DB_PROFILES)}")
+    return path, profile
@@ -1,50 +1,108 @@
 """
     Relational representation of DUPR Data
 """
-from datetime import date
+from datetime import datetime, timedelta
 from typing import List, Optional
 from loguru import logger
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, exc, inspect
 from sqlalchemy import String, ForeignKey, Integer, Float
-from sqlalchemy import Table, Column, select
-from sqlalchemy.orm import Session
+from sqlalchemy import Table, Column, Index, Select, UniqueConstraint, select, delete, text, or_, func
+from sqlalchemy import bindparam, case
+from sqlalchemy.orm import Session, aliased
 from sqlalchemy.orm import DeclarativeBase
 from sqlalchemy.orm import Mapped, mapped_column, relationship
+from sqlalchemy.dialects.sqlite import insert
+
+import dupr_resources
+from dupr_config import DB_PROFILES, db_config
 
 
 engine = None
 
 
-def open_db():
+def open_db(path: str = None, profile: str = None):
     global engine
+    path, profile = db_config(path, profile)
     # engine = create_engine("sqlite+pysqlite:///:memory:", echo=False)
-    engine = create_engine("sqlite+pysqlite:///dupr.sqlite", echo=False)
+    engine = create_engine(f"sqlite+pysqlite:///{path}", echo=False)
+    pragmas = DB_PROFILES[profile]
+    if pragmas:
+        @event.listens_for(engine, "connect")
+        def set_pragmas(dbapi_conn, _record):
+            cursor = dbapi_conn.cursor()
+            for k, v in pragmas.items():
+                cursor.execute(f"PRAGMA {k}={v}")
+            cursor.close()
+    logger.debug(f"open db {path} profile {profile}")
     Base.metadata.create_all(engine)
+    _add_missing_columns(engine)
+    _create_missing_indexes(engine)
     return engine
 
 
-class Base(DeclarativeBase):
-    pass
+def _add_missing_columns(engine):
+    """ create_all does not alter existing tables, so add any column
+        that is declared but missing in an older database.
+    """
+    insp = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            have = {c["name"] for c in insp.get_columns(table.name)}
+            for col in table.columns:
+                if col.name in have:
+                    continue
+                ddl = f"ALTER TABLE {table.name} ADD COLUMN {col.name} {col.type.compile(engine.dialect)}"
+                if col.server_default is not None:
+                    ddl += f" DEFAULT {col.server_default.arg}"
+                logger.info(f"add column {table.name}.{col.name}")
+                conn.execute(text(ddl))
+
+
+def _create_missing_indexes(engine):
+    """ create_all only creates indexes for new tables, so add any
+        index that is declared but missing in an older database.
+        A unique index the data does not allow is an error: the upserts
+        rely on it, so the database must be fixed (or rebuilt) first.
+    """
+    for table in Base.metadata.sorted_tables:
+        for idx in table.indexes:
+            try:
+                idx.create(engine, checkfirst=True)
+            except exc.IntegrityError:
+                cols = ", ".join(c.name for c in idx.columns)
+                with engine.connect() as conn:
+                    dups = conn.execute(text(
+                        f"SELECT {cols}, count(*) FROM {table.name} GROUP BY {cols} "
+                        f"HAVING count(*) > 1 LIMIT 5")).all()
+                raise ValueError(
+                    f"cannot create unique index {idx.name}: {table.name} has duplicate "
+                    f"({cols}) values, e.g. {', '.join(str(tuple(d[:-1])) for d in dups)}. "
+                    f"Remove the duplicates, or rebuild the database with rebuild-db") from None
 
 
-def _fix_rating_json(data: dict) -> dict:
-    # This is a very much a KLUDGE because the api
-    # returns ratings in two different ways depending
-    # on the player get call or the club member call
-    if data.get("ratings"):
-        r = data.pop("ratings")
-        for (k, v) in r.items():
-            data[k] = v
-    return data
+class Base(DeclarativeBase):
+    pass
 
 
-def _cv_rating_json(s: str):
-    # deal with NR vs 3.45
-    if s is None:
-        return None
-    if s == "NR":
-        return None
-    return float(s)
+def _player_values(p: dupr_resources.Player) -> tuple[dict, dict]:
+    """ Column values for the player and rating tables from a player record """
+    player = {
+        "dupr_id": p.dupr_id,
+        "full_name": p.full_name,
+        "image_url": p.image_url,
+        "email": p.email,
+        "gender": p.gender,
+        "age": p.age,
+    }
+    rating = {
+        "singles": p.singles,
+        "singles_verified": p.singles_verified,
+        "is_singles_provisional": p.singles_provisional,
+        "doubles": p.doubles,
+        "doubles_verified": p.doubles_verified,
+        "is_doubles_provisional": p.doubles_provisional,
+    }
+    return player, rating
 
 
 class Rating(Base):
@@ -59,7 +117,11 @@ class Rating(Base):
     singles_verified: Mapped[Optional[float]] = mapped_column(Float)
     is_singles_provisional: Mapped[bool] = mapped_column(default=True)
 
-    player_id: Mapped[int] = mapped_column(ForeignKey("player.id"))
+    # when the rating was last fetched from the API (or tried, if that failed),
+    # None for players only seen in matches
+    fetched_at: Mapped[Optional[datetime]] = mapped_column()
+
+    player_id: Mapped[int] = mapped_column(ForeignKey("player.id"), unique=True, index=True)
     player: Mapped["Player"] = relationship(back_populates="rating")
 
     @staticmethod
@@ -84,12 +146,19 @@ class Rating(Base):
     def __repr__(self) -> str:
         return f"{self.doubles_rating()} / {self.singles_rating()}"
 
+    @classmethod
+    def touch(cls, sess: Session, dupr_ids: list):
+        """ Record a fetch attempt that failed, so it is not retried every run """
+        sess.execute(Rating.__table__.update().where(Rating.player_id.in_(
+            select(Player.id).where(Player.dupr_id.in_(dupr_ids)))).values(
+            fetched_at=datetime.now()))
+
 
 class Player(Base):
     __tablename__ = "player"
 
     id: Mapped[int] = mapped_column(primary_key=True)
-    dupr_id: Mapped[int] = mapped_column(Integer)
+    dupr_id: Mapped[int] = mapped_column(Integer, unique=True, index=True)
     full_name: Mapped[str] = mapped_column(String(128))
     first_name: Mapped[Optional[str]] = mapped_column(String(128))
     last_name: Mapped[Optional[str]] = mapped_column(String(128))
@@ -98,6 +167,8 @@ class Player(Base):
     image_url: Mapped[Optional[str]] = mapped_column(String(256))
     email: Mapped[Optional[str]] = mapped_column(String(256))
     phone: Mapped[Optional[str]] = mapped_column(String(64))
+    # False for the limited data players saved from match history
+    is_complete: Mapped[bool] = mapped_column(default=False, server_default="0")
 
     # Note: in 1-1 mapping, no need to use the uselist=false
     # param if we are using Mapped annotation
@@ -111,76 +182,140 @@ class Player(Base):
         return f"Player {self.full_name} {self.rating}"
 
     @classmethod
-    def get(cls, sess: Session, dupr_id: int) -> "Player":
-        """ Get player by id, or none
+    def bulk_upsert(cls, sess: Session, members: list, chunk_size: int = 500,
+                    fetched_at: datetime = None) -> int:
+        """ Insert or update many players and their ratings from player records,
+            with a few INSERT ... ON CONFLICT(dupr_id) DO UPDATE statements.
+            A rating fetched before the stored one is not written, so
+            rebuilding from an archive keeps the newest rating whatever
+            order the calls are loaded in. Caller commits, so it all
+            goes in one transaction.
         """
-        p = sess.execute(select(Player).where(
-            Player.dupr_id == dupr_id)).scalar_one_or_none()
-        return p
+        fetched_at = fetched_at or datetime.now()
+        players = {}
+        ratings = {}
+        for d in members:
+            p, r = _player_values(d)
+            if p["dupr_id"] is None:
+                continue
+            p["is_complete"] = True
+            r["fetched_at"] = fetched_at
+            # last one wins
+            players[p["dupr_id"]] = p
+            ratings[p["dupr_id"]] = r
+
+        rows = list(players.values())
+        if not rows:
+            return 0
+        stmt = insert(Player)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[Player.dupr_id],
+            set_={k: stmt.excluded[k] for k in rows[0] if k != "dupr_id"})
+        sess.execute(stmt, rows)
+
+        dupr_ids = list(players)
+        rating_rows = []
+        for i in range(0, len(dupr_ids), chunk_size):
+            for pid, dupr_id in sess.execute(select(Player.id, Player.dupr_id).where(
+                    Player.dupr_id.in_(dupr_ids[i:i + chunk_size]))):
+                rating_rows.append(dict(ratings[dupr_id], player_id=pid))
+        stmt = insert(Rating)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[Rating.player_id],
+            set_={k: stmt.excluded[k] for k in rating_rows[0] if k != "player_id"},
+            where=Rating.fetched_at.is_(None) | (stmt.excluded.fetched_at >= Rating.fetched_at))
+        sess.execute(stmt, rating_rows)
+        RatingSnapshot.record(sess, [r["player_id"] for r in rating_rows], chunk_size)
+        return len(rows)
+
+
+class RatingSnapshot(Base):
+    """
+    Append-only rating history. A row is added for a player only when
+    a fetched rating differs from their latest snapshot, so daily
+    refreshes of unchanged ratings take no space.
+    """
+
+    __tablename__ = "rating_snapshot"
+    __table_args__ = (Index("ix_rating_snapshot_player_observed", "player_id", "observed_at"),)
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    player_id: Mapped[int] = mapped_column(ForeignKey("player.id"))
+    observed_at: Mapped[datetime] = mapped_column()
+    doubles: Mapped[Optional[float]] = mapped_column(Float)
+    doubles_verified: Mapped[Optional[float]] = mapped_column(Float)
+    is_doubles_provisional: Mapped[Optional[bool]] = mapped_column()
+    singles: Mapped[Optional[float]] = mapped_column(Float)
+    singles_verified: Mapped[Optional[float]] = mapped_column(Float)
+    is_singles_provisional: Mapped[Optional[bool]] = mapped_column()
+
+    VALUES = ("doubles", "doubles_verified", "is_doubles_provisional",
+              "singles", "singles_verified", "is_singles_provisional")
+
+    RECORD_SQL = f"""
+        INSERT INTO rating_snapshot (player_id, observed_at, {", ".join(VALUES)})
+        SELECT r.player_id, r.fetched_at, {", ".join(f"r.{v}" for v in VALUES)}
+        FROM rating AS r
+        LEFT JOIN rating_snapshot AS s ON s.id = (
+            SELECT id FROM rating_snapshot
+            WHERE player_id = r.player_id
+            ORDER BY observed_at DESC, id DESC LIMIT 1)
+        WHERE r.player_id IN :player_ids
+          AND r.fetched_at IS NOT NULL
+          AND (s.id IS NULL OR {" OR ".join(f"s.{v} IS NOT r.{v}" for v in VALUES)})
+    """
 
     @classmethod
-    def save(this, sess: Session, player: "Player") -> "Player":
-        """ Insert or update this player
-            Deal with child objects
+    def record(cls, sess: Session, player_ids: list, chunk_size: int = 500) -> int:
+        """ Snapshot the current (fetched) ratings of these players where
+            they changed. Caller commits.
         """
-        p = Player.get(sess, player.dupr_id)
-        if p:
-            # update, carefully
-            p.full_name = player.full_name
-            p.first_name = player.first_name
-            p.last_name = player.last_name
-            p.gender = player.gender
-            p.age = player.age
-            p.image_url = player.image_url
-            p.email = player.email
-            p.phone = player.phone
-
-            p.rating.doubles = player.rating.doubles if player.rating.doubles else None
-            p.rating.doubles_verified = player.rating.doubles_verified if player.rating.doubles_verified else None
-            p.rating.is_doubles_provisional = player.rating.is_doubles_provisional
-
-            p.rating.singles = player.rating.singles if player.rating.singles else None
-            p.rating.singles_verified = player.rating.singles_verified if player.rating.singles_verified else None
-            p.rating.is_singles_provisional = player.rating.is_singles_provisional
-            sess.add(p)
-            return p
-        else:
-            sess.add(player)
-            return player
+        sql = text(cls.RECORD_SQL).bindparams(bindparam("player_ids", expanding=True))
+        n = 0
+        for i in range(0, len(player_ids), chunk_size):
+            n += sess.execute(sql, {"player_ids": player_ids[i:i + chunk_size]}).rowcount
+        return n
+
+
+def _players_filter(q: Select, dupr_ids: list = None, club_id: str = None) -> Select:
+    if dupr_ids:
+        q = q.where(Player.dupr_id.in_(dupr_ids))
+    if club_id:
+        q = q.join(ClubMember, ClubMember.player_id == Player.id).where(
+            ClubMember.club_id == str(club_id))
+    return q
+
+
+def _snapshot_as_of(when: datetime):
+    """ Latest snapshot per player observed at or before when """
+    ranked = select(RatingSnapshot, func.row_number().over(
+        partition_by=RatingSnapshot.player_id,
+        order_by=(RatingSnapshot.observed_at.desc(), RatingSnapshot.id.desc())).label("n")).where(
+        RatingSnapshot.observed_at <= when).subquery()
+    return select(ranked).where(ranked.c.n == 1).subquery()
+
+
+def rating_as_of(when: datetime, dupr_ids: list = None, club_id: str = None) -> Select:
+    """ Each player's rating as it was at when: dupr id, name, observed at
+        and the rating values. Players not rated by then are left out.
+    """
+    s = _snapshot_as_of(when)
+    q = select(Player.dupr_id, Player.full_name, s.c.observed_at,
+               *[s.c[v] for v in RatingSnapshot.VALUES]).join(s, s.c.player_id == Player.id)
+    return _players_filter(q, dupr_ids, club_id).order_by(Player.dupr_id)
 
-    @classmethod
-    def from_json(cls, d: dict) -> 'Player':
-        try:
-            p = Player()
-            # this can be duprId or id
-            p.dupr_id = d.get("duprId")
-            if not p.dupr_id:
-                p.dupr_id = d.get("id")
-            # There seems to a API bug where player in matches
-            # return a different DuprID in the form of NNNANNN where as
-            # other IDs are just numeric. So stick to id field
-            p.dupr_id = d.get("id")
-            p.full_name = d.get("fullName")
-            p.image_url = d.get("imageUrl")
-
-            p.email = d.get("email")
-            p.gender = d.get("gender")
-            p.age = d.get("age")
-
-            p.rating = Rating()
-
-            _fix_rating_json(d)
-            p.rating.singles = _cv_rating_json(d.get("singles"))
-            p.rating.singles_verified = _cv_rating_json(d.get("singlesVerified"))
-            p.rating.is_singles_provisional = d.get("singlesProvisional")
-
-            p.rating.doubles = _cv_rating_json(d.get("doubles"))
-            p.rating.doubles_verified = _cv_rating_json(d.get("doublesVerified"))
-            p.rating.is_doubles_provisional = d.get("doublesProvisional")
-            return p
-        except:
-            logger.exception(d)
-            raise
+
+def rating_change(start: datetime, end: datetime, dupr_ids: list = None, club_id: str = None) -> Select:
+    """ Rating at start and at end, and the change, per player:
+        dupr id, name, doubles start / end / change, singles start / end / change.
+    """
+    a = _snapshot_as_of(start)
+    b = _snapshot_as_of(end)
+    q = select(Player.dupr_id, Player.full_name,
+               a.c.doubles, b.c.doubles, func.round(b.c.doubles - a.c.doubles, 3).label("doubles_change"),
+               a.c.singles, b.c.singles, func.round(b.c.singles - a.c.singles, 3).label("singles_change")
+               ).join(b, b.c.player_id == Player.id).outerjoin(a, a.c.player_id == Player.id)
+    return _players_filter(q, dupr_ids, club_id).order_by(Player.dupr_id)
 
 
 class Match(Base):
@@ -205,41 +340,19 @@ class Match(Base):
         return m
 
     @classmethod
-    def from_json(cls, d: dict):
-
-        try:
-            m = Match()
-            m.match_id = d.get("matchId")
-            m.user_id = d.get("userId")
-            m.display_identity = d.get("displayIdentity")
-            m.confirmed = d.get("confirmed")
-            m.date = date.fromisoformat(d.get("eventDate"))
-            # need to try different fields...
-            m.name = d.get("eventName")
-            if not m.name:
-                m.name = d.get("league")
-            if not m.name:
-                m.name = d.get("tournament", "")
-            m.event_format = d.get("eventFormat")
-            m.match_score_added = d.get("matchScoreAdded")
-            m.match_source = d.get("matchSource")
-            m.match_type = d.get("matchType")
-
-            for jt in d.get("teams"):
-                t = MatchTeam().from_json(jt)
-                m.teams.append(t)
-            return m
-
-        except:
-            logger.exception(d)
-            raise
+    def known_ids(cls, sess: Session, match_ids: list) -> set:
+        """ Return the subset of DUPR match ids already in the database """
+        if not match_ids:
+            return set()
+        return set(sess.scalars(select(Match.match_id).where(
+            Match.match_id.in_(match_ids))))
 
 
 match_team_player = Table(
     "match_team_player",
     Base.metadata,
-    Column("match_team_id", ForeignKey("match_team.id")),
-    Column("player_id", ForeignKey("player.id"))
+    Column("match_team_id", ForeignKey("match_team.id"), index=True),
+    Column("player_id", ForeignKey("player.id"), index=True)
 )
 
 
@@ -247,7 +360,7 @@ class MatchTeam(Base):
     __tablename__ = "match_team"
 
     id: Mapped[int] = mapped_column(primary_key=True)
-    match_id = mapped_column(ForeignKey("match.id"))
+    match_id = mapped_column(ForeignKey("match.id"), index=True)
     match: Mapped[Match] = relationship(back_populates="teams")
     score1: Mapped[int] = mapped_column()
     score2: Mapped[Optional[int]] = mapped_column()
@@ -262,27 +375,6 @@ class MatchTeam(Base):
         ps = ",".join([p.full_name for p in self.players])
         return f"Match Team {ps}"
 
-    @classmethod
-    def from_json(cls, d: dict):
-
-        try:
-            mt = MatchTeam()
-            mt.score1 = d.get("game1")
-            mt.score2 = d.get("game2")
-            mt.score3 = d.get("game3")
-            p = Player().from_json(d.get("player1"))
-            mt.players.append(p)
-            pdata = d.get("player2")
-            if pdata:
-                p2 = Player().from_json(pdata)
-                mt.players.append(p2)
-            mt.is_winner = d.get("winner")
-            return mt
-
-        except:
-            logger.exception(d)
-            raise
-
 
 class MatchDetail(Base):
     """
@@ -293,7 +385,7 @@ class MatchDetail(Base):
     __tablename__ = "match_detail"
 
     id: Mapped[int] = mapped_column(primary_key=True)
-    match_id: Mapped[int] = mapped_column(ForeignKey("match.id"))
+    match_id: Mapped[int] = mapped_column(ForeignKey("match.id"), index=True)
     match: Mapped["Match"] = relationship()
     # team 1 is the winning team
     team_1_score: Mapped[int] = mapped_column()
@@ -312,3 +404,493 @@ class MatchDetail(Base):
         m = sess.execute(select(Match).where(
             Match.match_id == match_id)).scalar_one_or_none()
         return m
+
+    # Team 1 / 2 and player 1 / 2 are in the order they were saved,
+    # the same as match.teams[0] and team.players[0] in the ORM.
+    # Matches without two teams with players are left out.
+    BUILD_SQL = """
+        INSERT INTO match_detail (
+            match_id, team_1_score, team_2_score,
+            team_1_player_1_id, team_1_player_2_id,
+            team_2_player_1_id, team_2_player_2_id)
+        SELECT
+            team.match_id,
+            max(CASE WHEN team_no = 1 THEN score1 END),
+            max(CASE WHEN team_no = 2 THEN score1 END),
+            max(CASE WHEN team_no = 1 AND player_no = 1 THEN player_id END),
+            max(CASE WHEN team_no = 1 AND player_no = 2 THEN player_id END),
+            max(CASE WHEN team_no = 2 AND player_no = 1 THEN player_id END),
+            max(CASE WHEN team_no = 2 AND player_no = 2 THEN player_id END)
+        FROM (
+            SELECT id, match_id, score1,
+                   row_number() OVER (PARTITION BY match_id ORDER BY id) AS team_no
+            FROM match_team {where}
+        ) AS team
+        JOIN (
+            SELECT match_team_id, player_id,
+                   row_number() OVER (PARTITION BY match_team_id ORDER BY rowid) AS player_no
+            FROM match_team_player
+        ) AS team_player ON team_player.match_team_id = team.id
+        WHERE team_no <= 2
+        GROUP BY team.match_id
+        HAVING max(CASE WHEN team_no = 1 AND player_no = 1 THEN player_id END) IS NOT NULL
+           AND max(CASE WHEN team_no = 2 AND player_no = 1 THEN player_id END) IS NOT NULL
+           AND max(CASE WHEN team_no = 1 THEN score1 END) IS NOT NULL
+           AND max(CASE WHEN team_no = 2 THEN score1 END) IS NOT NULL
+    """
+
+    @classmethod
+    def build(cls, sess: Session, incremental: bool = False) -> int:
+        """ Fill match_detail with one INSERT ... SELECT, return rows added.
+            Full rebuild, or only the matches missing from match_detail.
+            Caller commits.
+        """
+        if incremental:
+            where = "WHERE match_id NOT IN (SELECT match_id FROM match_detail)"
+        else:
+            sess.execute(delete(MatchDetail))
+            where = ""
+        r = sess.execute(text(cls.BUILD_SQL.format(where=where)))
+        return r.rowcount
+
+
+class MatchAnalytics(Base):
+    """
+    Per match rating metrics computed from match_detail and current
+    ratings by dupr_analytics (duprly.py analyze).
+    """
+
+    __tablename__ = "match_analytics"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    match_id: Mapped[int] = mapped_column(ForeignKey("match.id"), unique=True, index=True)
+    # average rating of each team, doubles or singles rating by match type
+    team_1_rating: Mapped[Optional[float]] = mapped_column(Float)
+    team_2_rating: Mapped[Optional[float]] = mapped_column(Float)
+    rating_diff: Mapped[Optional[float]] = mapped_column(Float)
+    # highest minus lowest player rating in the match
+    rating_spread: Mapped[Optional[float]] = mapped_column(Float)
+    team_1_win_prob: Mapped[Optional[float]] = mapped_column(Float)
+    team_1_won: Mapped[bool] = mapped_column()
+    upset: Mapped[bool] = mapped_column(default=False)
+
+
+def _refresh_players(sess: Session, model, sql: str, player_ids=None,
+                     chunk_size: int = 500) -> int:
+    """ Delete and rebuild a per player summary table with its INSERT ... SELECT,
+        for all players or for chunks of player_ids. Return rows inserted.
+    """
+    if player_ids is None:
+        sess.execute(delete(model))
+        return sess.execute(text(sql.format(where=""))).rowcount
+    ids = list(player_ids)
+    stmt = text(sql.format(where="WHERE a.player_id IN :ids")).bindparams(
+        bindparam("ids", expanding=True))
+    n = 0
+    for i in range(0, len(ids), chunk_size):
+        chunk = ids[i:i + chunk_size]
+        sess.execute(delete(model).where(model.player_id.in_(chunk)))
+        n += sess.execute(stmt, {"ids": chunk}).rowcount
+    return n
+
+
+class PlayerSummary(Base):
+    """
+    Materialized per player match summary, so the datasette player page
+    does not have to count matches over five tables on every load.
+    """
+
+    __tablename__ = "player_summary"
+
+    player_id: Mapped[int] = mapped_column(ForeignKey("player.id"), primary_key=True)
+    matches_played: Mapped[int] = mapped_column(default=0)
+    wins: Mapped[int] = mapped_column(default=0)
+    last_match_date: Mapped[Optional[str]] = mapped_column(String(16))
+
+    BUILD_SQL = """
+        INSERT INTO player_summary (player_id, matches_played, wins, last_match_date)
+        SELECT a.player_id,
+               count(DISTINCT t.match_id),
+               count(DISTINCT CASE WHEN t.is_winner THEN t.match_id END),
+               max(m.date)
+        FROM match_team_player AS a
+        JOIN match_team AS t ON t.id = a.match_team_id
+        JOIN match AS m ON m.id = t.match_id
+        {where}
+        GROUP BY a.player_id
+    """
+
+    @classmethod
+    def refresh(cls, sess: Session, player_ids=None) -> int:
+        """ Rebuild the summary of all players, or just of player_ids """
+        return _refresh_players(sess, cls, cls.BUILD_SQL, player_ids)
+
+
+class PlayerRelation(Base):
+    """
+    Materialized partner / opponent counts for each pair of players,
+    query by player_id ordered by matches for frequent partners.
+    """
+
+    __tablename__ = "player_relation"
+    __table_args__ = (UniqueConstraint("player_id", "other_id", "kind"),)
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    player_id: Mapped[int] = mapped_column(ForeignKey("player.id"), index=True)
+    other_id: Mapped[int] = mapped_column(ForeignKey("player.id"))
+    kind: Mapped[str] = mapped_column(String(16))  # partner or opponent
+    matches: Mapped[int] = mapped_column(default=0)
+    wins: Mapped[int] = mapped_column(default=0)  # won by player_id
+    last_match_date: Mapped[Optional[str]] = mapped_column(String(16))
+
+    BUILD_SQL = """
+        INSERT INTO player_relation (player_id, other_id, kind, matches, wins, last_match_date)
+        SELECT a.player_id, b.player_id,
+               CASE WHEN ta.id = tb.id THEN 'partner' ELSE 'opponent' END AS kind,
+               count(DISTINCT ta.match_id),
+               count(DISTINCT CASE WHEN ta.is_winner THEN ta.match_id END),
+               max(m.date)
+        FROM match_team_player AS a
+        JOIN match_team AS ta ON ta.id = a.match_team_id
+        JOIN match_team AS tb ON tb.match_id = ta.match_id
+        JOIN match_team_player AS b ON b.match_team_id = tb.id AND b.player_id != a.player_id
+        JOIN match AS m ON m.id = ta.match_id
+        {where}
+        GROUP BY a.player_id, b.player_id, kind
+    """
+
+    @classmethod
+    def refresh(cls, sess: Session, player_ids=None) -> int:
+        """ Rebuild the relations of all players, or just of player_ids """
+        return _refresh_players(sess, cls, cls.BUILD_SQL, player_ids)
+
+
+class ClubMember(Base):
+    """ Which players were listed as members of a club """
+
+    __tablename__ = "club_member"
+    __table_args__ = (UniqueConstraint("club_id", "player_id"),)
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    club_id: Mapped[str] = mapped_column(String(64), index=True)
+    player_id: Mapped[int] = mapped_column(ForeignKey("player.id"))
+
+    @classmethod
+    def add_members(cls, sess: Session, club_id: str, members: list) -> int:
+        """ Record club membership for player records (players already saved) """
+        dupr_ids = [p.dupr_id for p in members]
+        rows = [{"club_id": str(club_id), "player_id": pid}
+                for pid in sess.scalars(select(Player.id).where(Player.dupr_id.in_(dupr_ids)))]
+        if rows:
+            sess.execute(insert(ClubMember).on_conflict_do_nothing(), rows)
+        return len(rows)
+
+
+def ratings_to_refresh(sess: Session, budget: int, max_age_days: int = 30) -> list:
+    """ DUPR ids of the players whose rating is most worth fetching, at most
+        budget of them, best first:
+
+        0. limited data players only seen in matches
+        1. players whose rating was never fetched
+        2. players who played since their rating was fetched
+        3. ratings older than max_age_days
+
+        Within each, players with the most recent matches come first.
+        Ratings only change when a player plays, so the rest are skipped.
+    """
+    fetched_day = func.date(Rating.fetched_at)
+    last_match = PlayerSummary.last_match_date
+    tier = case(
+        (Player.is_complete.is_(False), 0),
+        (Rating.fetched_at.is_(None), 1),
+        (last_match > fetched_day, 2),
+        else_=3)
+    q = select(Player.dupr_id).join(Rating, Rating.player_id == Player.id).outerjoin(
+        PlayerSummary, PlayerSummary.player_id == Player.id).where(or_(
+            Rating.fetched_at.is_(None),
+            Rating.fetched_at < datetime.now() - timedelta(days=max_age_days),
+            last_match > fetched_day)).order_by(
+        tier, last_match.desc().nulls_last(), Player.id).limit(budget)
+    return sess.scalars(q).all()
+
+
+def report_players(club_id: str = None) -> Select:
+    """ Players with ratings, optionally only members of a club """
+    q = select(Player.id, Player.dupr_id, Player.full_name, Player.gender, Player.age,
+               Rating.singles, Rating.singles_verified, Rating.is_singles_provisional,
+               Rating.doubles, Rating.doubles_verified, Rating.is_doubles_provisional
+               ).outerjoin(Rating, Rating.player_id == Player.id)
+    if club_id:
+        q = q.join(ClubMember, ClubMember.player_id == Player.id).where(
+            ClubMember.club_id == str(club_id))
+    return q.order_by(Player.id)
+
+
+def report_matches(since: str = None, until: str = None, club_id: str = None) -> Select:
+    """ match_detail with match, player and current rating columns.
+        since / until are inclusive ISO dates, club_id keeps matches
+        with at least one member of that club.
+    """
+    cols = [Match.match_id, Match.name, Match.date, Match.match_type, Match.match_source,
+            MatchDetail.team_1_score]
+    joins = []
+    for n, fk in enumerate([MatchDetail.team_1_player_1_id, MatchDetail.team_1_player_2_id,
+                            MatchDetail.team_2_player_1_id, MatchDetail.team_2_player_2_id]):
+        p = aliased(Player, name=f"p{n + 1}")
+        r = aliased(Rating, name=f"r{n + 1}")
+        cols += [p.dupr_id, p.full_name, r.doubles]
+        if n == 1:
+            cols.append(MatchDetail.team_2_score)
+        joins.append((p, r, fk))
+    q = select(*cols).join(Match, Match.id == MatchDetail.match_id)
+    for p, r, fk in joins:
+        q = q.outerjoin(p, p.id == fk).outerjoin(r, r.player_id == p.id)
+    if since:
+        q = q.where(Match.date >= since)
+    if until:
+        q = q.where(Match.date <= until)
+    if club_id:
+        members = select(ClubMember.player_id).where(ClubMember.club_id == str(club_id))
+        q = q.where(or_(*[fk.in_(members) for _p, _r, fk in joins]))
+    return q.order_by(Match.date, Match.id)
+
+
+def _match_values(m: dupr_resources.Match) -> dict:
+    """ Column values for the match table from a match record """
+    return {
+        "match_id": m.match_id,
+        "name": m.name,
+        "date": m.event_date,
+        "match_type": m.match_type,
+        "match_source": m.match_source,
+        "match_score_added": m.match_score_added,
+    }
+
+
+class SyncIdentityMap(object):
+    """
+    Sync scoped map of what is already in the database:
+    dupr_id -> player.id and the set of known DUPR match ids.
+
+    A page of matches is checked against it (with one IN query for ids it
+    has not seen, unless preloaded), and only genuinely new matches and
+    players are written, with plain inserts instead of ORM object graphs.
+    Use one map per sync run, from one writer thread.
+    """
+
+    def __init__(self):
+        self.players = {}
+        self.match_ids = set()
+        self.preloaded = False
+        self.touched = set()  # player.id of players in the matches added
+
+    def preload(self, sess: Session) -> "SyncIdentityMap":
+        """ Load all player and match ids in bulk """
+        self.players = dict(sess.execute(select(Player.dupr_id, Player.id)).tuples().all())
+        self.match_ids = set(sess.scalars(select(Match.match_id)))
+        self.preloaded = True
+        logger.debug(f"identity map: {len(self.players)} players, {len(self.match_ids)} matches")
+        return self
+
+    def new_matches(self, sess: Session, matches: list) -> list:
+        """ Match records of a page that are not in the database yet """
+        unseen = [m.match_id for m in matches if m.match_id not in self.match_ids]
+        if unseen and not self.preloaded:
+            self.match_ids.update(Match.known_ids(sess, unseen))
+        new = []
+        for m in matches:
+            if m.match_id not in self.match_ids:
+                # also guards against the same match twice in one page
+                self.match_ids.add(m.match_id)
+                new.append(m)
+        return new
+
+    def player_id(self, sess: Session, d: dupr_resources.Player) -> int:
+        """ Database id of the player of this player record,
+            inserting a limited data player if it is new.
+        """
+        p, r = _player_values(d)
+        dupr_id = p["dupr_id"]
+        pid = self.players.get(dupr_id)
+        if pid is None and not self.preloaded:
+            pid = sess.scalar(select(Player.id).where(Player.dupr_id == dupr_id))
+        if pid is None:
+            pid = sess.execute(insert(Player.__table__), p).inserted_primary_key[0]
+            sess.execute(insert(Rating.__table__), dict(r, player_id=pid))
+            logger.debug(f"saved new limited data player {dupr_id}")
+        self.players[dupr_id] = pid
+        return pid
+
+    def add_matches(self, sess: Session, matches: list) -> int:
+        """ Add the new match records of a page, return how many. Caller commits. """
+        new = self.new_matches(sess, matches)
+        for d in new:
+            self.add_match(sess, d)
+        return len(new)
+
+    def add_match(self, sess: Session, m: dupr_resources.Match):
+        try:
+            mid = sess.execute(insert(Match.__table__),
+                               _match_values(m)).inserted_primary_key[0]
+            for t in m.teams:
+                tid = sess.execute(insert(MatchTeam.__table__), {
+                    "match_id": mid,
+                    "score1": t.score1,
+                    "score2": t.score2,
+                    "score3": t.score3,
+                    "is_winner": t.winner,
+                }).inserted_primary_key[0]
+                pids = [self.player_id(sess, t.player1)]
+                if t.player2:
+                    p2 = self.player_id(sess, t.player2)
+                    # We need to handle a strange case where the same player
+                    # enter himself/herself twice on a doubles team.
+                    if p2 == pids[0]:
+                        logger.warning(f"same player on doubles team {p2} {m.match_id}")
+                    else:
+                        pids.append(p2)
+                sess.execute(insert(match_team_player),
+                             [{"match_team_id": tid, "player_id": pid} for pid in pids])
+                self.touched.update(pids)
+        except Exception:
+            logger.exception(m)
+            raise
+
+
+class PlayerSync(Base):
+    """
+    Per player match history sync watermark. A player with a watermark
+    has had a full history sync, so later runs can stop paging as soon
+    as they reach matches that are already in the database.
+    """
+
+    __tablename__ = "player_sync"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    dupr_id: Mapped[int] = mapped_column(Integer, unique=True)
+    newest_match_id: Mapped[Optional[int]] = mapped_column()
+    newest_match_date: Mapped[Optional[str]] = mapped_column(String(16))
+    synced_at: Mapped[Optional[datetime]] = mapped_column()
+
+    def __repr__(self) -> str:
+        return f"PlayerSync {self.dupr_id} {self.newest_match_date} at {self.synced_at}"
+
+    @classmethod
+    def get(cls, sess: Session, dupr_id: int) -> "PlayerSync":
+        return sess.execute(select(PlayerSync).where(
+            PlayerSync.dupr_id == dupr_id)).scalar_one_or_none()
+
+    @classmethod
+    def mark(cls, sess: Session, dupr_id: int, matches: list) -> "PlayerSync":
+        """ Record a completed sync, matches are newest first (match records) """
+        ps = PlayerSync.get(sess, dupr_id)
+        if not ps:
+            ps = PlayerSync(dupr_id=dupr_id)
+            sess.add(ps)
+        if matches:
+            newest = matches[0]
+            if not ps.newest_match_date or newest.event_date >= ps.newest_match_date:
+                ps.newest_match_id = newest.match_id
+                ps.newest_match_date = newest.event_date
+        ps.synced_at = datetime.now()
+        return ps
+
+
+class CrawlFrontier(Base):
+    """
+    Persistent crawl queue for get-data. Club members are seeded at depth 0,
+    players met in their matches are queued at depth 1, and so on up to the
+    max depth of the crawl. Each player is in it once, at the lowest depth
+    it was seen at. A player is marked done in the same transaction that
+    saves their matches, so an interrupted crawl can be resumed exactly.
+    """
+
+    __tablename__ = "crawl_frontier"
+    __table_args__ = (Index("ix_crawl_frontier_state_depth", "state", "depth"),)
+
+    QUEUED = "queued"
+    IN_PROGRESS = "in_progress"
+    DONE = "done"
+    FAILED = "failed"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    dupr_id: Mapped[int] = mapped_column(Integer, unique=True)
+    depth: Mapped[int] = mapped_column(Integer)
+    state: Mapped[str] = mapped_column(String(16))
+    updated_at: Mapped[Optional[datetime]] = mapped_column()
+
+    def __repr__(self) -> str:
+        return f"CrawlFrontier {self.dupr_id} depth {self.depth} {self.state}"
+
+    @classmethod
+    def clear(cls, sess: Session):
+        sess.execute(delete(CrawlFrontier))
+
+    @classmethod
+    def enqueue(cls, sess: Session, dupr_ids, depth: int) -> int:
+        """ Queue players not seen yet. One already queued deeper moves up to depth. """
+        rows = [{"dupr_id": i, "depth": depth, "state": cls.QUEUED, "updated_at": datetime.now()}
+                for i in set(dupr_ids) if i is not None]
+        if not rows:
+            return 0
+        t = CrawlFrontier.__table__
+        stmt = insert(t)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[t.c.dupr_id],
+            set_={"depth": stmt.excluded.depth},
+            where=(t.c.state == cls.QUEUED) & (t.c.depth > stmt.excluded.depth))
+        return sess.execute(stmt, rows).rowcount
+
+    @classmethod
+    def claim(cls, sess: Session, n: int) -> dict:
+        """ Mark the next n queued players in progress, lowest depth first.
+            Return dupr_id -> depth. Caller commits.
+        """
+        rows = sess.execute(select(CrawlFrontier.dupr_id, CrawlFrontier.depth).where(
+            CrawlFrontier.state == cls.QUEUED).order_by(
+            CrawlFrontier.depth, CrawlFrontier.id).limit(n)).tuples().all()
+        cls._set_state(sess, [r[0] for r in rows], cls.IN_PROGRESS)
+        return dict(rows)
+
+    @classmethod
+    def _set_state(cls, sess: Session, dupr_ids: list, state: str):
+        for i in range(0, len(dupr_ids), 500):
+            sess.execute(CrawlFrontier.__table__.update().where(
+                CrawlFrontier.dupr_id.in_(dupr_ids[i:i + 500])).values(
+                state=state, updated_at=datetime.now()))
+
+    @classmethod
+    def done(cls, sess: Session, dupr_id: int, matches: list, max_depth: int) -> int:
+        """ Mark a player done and queue the players in their matches
+            (match records) one hop further, if that is within max_depth.
+            Return how many were queued. Caller commits.
+        """
+        cls._set_state(sess, [dupr_id], cls.DONE)
+        return cls.enqueue_met(sess, dupr_id, matches, max_depth)
+
+    @classmethod
+    def enqueue_met(cls, sess: Session, dupr_id: int, matches: list, max_depth: int) -> int:
+        """ Queue the players in some of a player's matches (match records) one
+            hop further, if that is within max_depth. Caller commits.
+        """
+        depth = sess.scalar(select(CrawlFrontier.depth).where(CrawlFrontier.dupr_id == dupr_id))
+        if depth is None or depth >= max_depth:
+            return 0
+        seen = [p.dupr_id for m in matches for p in m.players()]
+        return cls.enqueue(sess, seen, depth + 1)
+
+    @classmethod
+    def failed(cls, sess: Session, dupr_id: int):
+        cls._set_state(sess, [dupr_id], cls.FAILED)
+
+    @classmethod
+    def resume(cls, sess: Session) -> int:
+        """ Queue again what an interrupted run had in progress or failed on """
+        return sess.execute(CrawlFrontier.__table__.update().where(
+            CrawlFrontier.state.in_((cls.IN_PROGRESS, cls.FAILED))).values(
+            state=cls.QUEUED, updated_at=datetime.now())).rowcount
+
+    @classmethod
+    def counts(cls, sess: Session) -> dict:
+        return dict(sess.execute(select(CrawlFrontier.state, func.count()).group_by(
+            CrawlFrontier.state)).tuples().all())
@@ -0,0 +1,142 @@
+"""
+    Streaming export of the database tables to CSV, NDJSON or Parquet.
+
+    Rows are read in batches (yield_per) and written out batch by batch,
+    so memory use stays bounded whatever the size of the table. Parquet
+    writes one row group per batch and needs pyarrow installed.
+
+    With since (YYYY-MM-DD), only rows for matches on or after that date
+    are exported, and only the players (and ratings) in those matches.
+"""
+import csv
+import json
+import sys
+from datetime import date, datetime
+from typing import Iterator
+
+from loguru import logger
+from sqlalchemy import Boolean, DateTime, Float, Integer, Table, select, union
+from sqlalchemy.orm import Session
+
+from dupr_db import Match, MatchDetail, Player, Rating
+
+TABLES = {
+    "player": Player.__table__,
+    "rating": Rating.__table__,
+    "match": Match.__table__,
+    "match_detail": MatchDetail.__table__,
+}
+
+
+def _players_since(since: str):
+    """ ids of players in matches on or after since """
+    md = MatchDetail.__table__
+    recent = select(md).join(Match.__table__, Match.id == md.c.match_id).where(
+        Match.date >= since).subquery()
+    return union(*[select(recent.c[c]) for c in (
+        "team_1_player_1_id", "team_1_player_2_id",
+        "team_2_player_1_id", "team_2_player_2_id")])
+
+
+def export_select(name: str, since: str = None):
+    table = TABLES[name]
+    q = select(table)
+    if since:
+        if name == "match":
+            q = q.where(table.c.date >= since)
+        elif name == "match_detail":
+            q = q.join(Match.__table__, Match.id == table.c.match_id).where(Match.date >= since)
+        elif name == "player":
+            q = q.where(table.c.id.in_(_players_since(since)))
+        elif name == "rating":
+            q = q.where(table.c.player_id.in_(_players_since(since)))
+    return q.order_by(table.c.id)
+
+
+def batches(sess: Session, name: str, since: str = None, batch_size: int = 10000) -> Iterator[list]:
+    """ Yield lists of row tuples, batch_size at a time """
+    q = export_select(name, since).execution_options(yield_per=batch_size)
+    for part in sess.execute(q).partitions():
+        yield [tuple(row) for row in part]
+
+
+def _json_default(v):
+    if isinstance(v, (date, datetime)):
+        return v.isoformat()
+    raise TypeError(f"cannot export {type(v)}")
+
+
+def write_csv(out, columns: list, rows: Iterator[list]) -> int:
+    w = csv.writer(out)
+    w.writerow(columns)
+    n = 0
+    for batch in rows:
+        w.writerows(batch)
+        n += len(batch)
+    return n
+
+
+def write_ndjson(out, columns: list, rows: Iterator[list]) -> int:
+    n = 0
+    for batch in rows:
+        out.writelines(json.dumps(dict(zip(columns, row)), default=_json_default) + "\n"
+                       for row in batch)
+        n += len(batch)
+    return n
+
+
+def arrow_schema(table: Table):
+    import pyarrow as pa
+
+    def arrow_type(t):
+        if isinstance(t, Boolean):
+            return pa.bool_()
+        if isinstance(t, Integer):
+            return pa.int64()
+        if isinstance(t, Float):
+            return pa.float64()
+        if isinstance(t, DateTime):
+            return pa.timestamp("us")
+        return pa.string()
+
+    return pa.schema([(c.name, arrow_type(c.type)) for c in table.columns])
+
+
+def write_parquet(path: str, table: Table, rows: Iterator[list]) -> int:
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError("parquet export needs pyarrow, pip install pyarrow")
+
+    schema = arrow_schema(table)
+    n = 0
+    with pq.ParquetWriter(path, schema) as w:
+        for batch in rows:
+            cols = list(zip(*batch))
+            w.write_batch(pa.record_batch(
+                [pa.array(col, type=f.type) for col, f in zip(cols, schema)], schema=schema))
+            n += len(batch)
+    return n
+
+
+def export_table(sess: Session, name: str, fmt: str, output: str = "-",
+                 since: str = None, batch_size: int = 10000) -> int:
+    """ Export one table, to a file or stdout ("-"), return rows written """
+    table = TABLES[name]
+    columns = [c.name for c in table.columns]
+    rows = batches(sess, name, since, batch_size)
+    if fmt == "parquet":
+        if output == "-":
+            raise ValueError("parquet export needs an output file")
+        n = write_parquet(output, table, rows)
+    else:
+        write = write_csv if fmt == "csv" else write_ndjson
+        if output == "-":
+            n = write(sys.stdout, columns, rows)
+            sys.stdout.flush()
+        else:
+            with open(output, "w", newline="") as f:
+                n = write(f, columns, rows)
+    logger.info(f"exported {n} {name} rows as {fmt}")
+    return n
@@ -0,0 +1,237 @@
+"""
+    Run metrics for duprly commands.
+
+    DuprClient reports every request it sends (call name, status, latency,
+    bytes, retries) and watch_engine() hooks the SQLAlchemy engine to time
+    SQL statements and commits and count rows written per table. At the end
+    of a command the summary tells whether the time went to the network or
+    to SQLite, and can be written as JSON or as a Prometheus textfile:
+
+        python duprly.py --metrics-json run.json get-data
+        python duprly.py --metrics-prom /var/lib/node_exporter/duprly.prom get-data
+
+    Times are summed over all threads, so with concurrent fetching the
+    network time can be larger than the wall time.
+"""
+import json
+import os
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+
+from loguru import logger
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+# latency histogram bucket upper bounds, seconds
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+
+WRITE_SQL = re.compile(r'^\s*(INSERT|UPDATE|DELETE)\b(?:\s+OR\s+\w+)?\s+(?:INTO|FROM)?\s*"?(\w+)', re.I)
+
+
+class Histogram(object):
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.total = 0.0
+        self.max = 0.0
+        self.n = 0
+
+    def observe(self, v: float):
+        for i, b in enumerate(BUCKETS):
+            if v <= b:
+                self.counts[i] += 1
+                break
+        self.total += v
+        self.max = max(self.max, v)
+        self.n += 1
+
+    def quantile(self, q: float) -> float:
+        """ Upper bound of the bucket holding the q quantile """
+        seen = 0
+        for b, c in zip(BUCKETS, self.counts):
+            seen += c
+            if seen >= q * self.n:
+                return b if b != float("inf") else self.max
+        return 0.0
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.n,
+            "sum": round(self.total, 6),
+            "max": round(self.max, 6),
+            "buckets": {str(b): c for b, c in zip(BUCKETS, self.counts)},
+        }
+
+
+class Metrics(object):
+
+    def __init__(self):
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        # per call name
+        self.requests = Counter()
+        self.latency = defaultdict(Histogram)
+        self.bytes = Counter()
+        self.retries = Counter()
+        self.status = defaultdict(Counter)
+        # database
+        self.sql_count = 0
+        self.sql_seconds = 0.0
+        self.commits = 0
+        self.commit_seconds = 0.0
+        self.rows = defaultdict(Counter)  # table -> {insert, update, delete}
+        self.engines = []
+
+    # network
+
+    def request(self, name: str, status: int, seconds: float, nbytes: int, retries: int = 0):
+        """ Record one request sent by the client """
+        name = name or "unknown"
+        with self.lock:
+            self.requests[name] += 1
+            self.latency[name].observe(seconds)
+            self.bytes[name] += nbytes
+            self.retries[name] += retries
+            self.status[name][status] += 1
+
+    # database
+
+    def watch_engine(self, engine: Engine):
+        """ Time the SQL and commits of an engine and count rows written """
+        if engine in self.engines:
+            return
+        self.engines.append(engine)
+        event.listen(engine, "before_cursor_execute", self._before_execute)
+        event.listen(engine, "after_cursor_execute", self._after_execute)
+        event.listen(engine, "commit", self._before_commit)
+        if len(self.engines) == 1:
+            event.listen(Session, "after_commit", self._after_commit)
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("metrics_t0", []).append(time.perf_counter())
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - conn.info["metrics_t0"].pop()
+        m = WRITE_SQL.match(statement)
+        with self.lock:
+            self.sql_count += 1
+            self.sql_seconds += seconds
+            if m and cursor.rowcount > 0:
+                self.rows[m.group(2).lower()][m.group(1).lower()] += cursor.rowcount
+
+    def _before_commit(self, conn):
+        self.local.commit_t0 = time.perf_counter()
+
+    def _after_commit(self, session):
+        t0 = getattr(self.local, "commit_t0", None)
+        if t0 is None:
+            return
+        self.local.commit_t0 = None
+        with self.lock:
+            self.commits += 1
+            self.commit_seconds += time.perf_counter() - t0
+
+    # output
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return {
+                "wall_seconds": round(time.time() - self.started, 3),
+                "http": {
+                    name: {
+                        "requests": self.requests[name],
+                        "bytes": self.bytes[name],
+                        "retries": self.retries[name],
+                        "status": {str(s): c for s, c in sorted(self.status[name].items())},
+                        "latency": self.latency[name].to_dict(),
+                    } for name in sorted(self.requests)
+                },
+                "db": {
+                    "statements": self.sql_count,
+                    "sql_seconds": round(self.sql_seconds, 3),
+                    "commits": self.commits,
+                    "commit_seconds": round(self.commit_seconds, 3),
+                    "rows": {t: dict(c) for t, c in sorted(self.rows.items())},
+                },
+            }
+
+    def summary(self, extra: dict = None):
+        """ Log a short summary of the run """
+        d = self.to_dict()
+        http_seconds = sum(h.total for h in self.latency.values())
+        logger.info(f"run: {d['wall_seconds']:.1f}s wall, "
+                    f"{http_seconds:.1f}s in {sum(self.requests.values())} requests, "
+                    f"{self.sql_seconds:.1f}s in {self.sql_count} SQL statements, "
+                    f"{self.commit_seconds:.1f}s in {self.commits} commits")
+        for name, h in d["http"].items():
+            lat = self.latency[name]
+            status = ", ".join(f"{s}: {c}" for s, c in h["status"].items())
+            logger.info(f"  {name}: {h['requests']} requests, {h['bytes'] / 1e6:.1f} MB, "
+                        f"p50 <= {lat.quantile(0.5)}s, p95 <= {lat.quantile(0.95)}s, "
+                        f"max {lat.max:.2f}s, {h['retries']} retries, status {status}")
+        for table, ops in d["db"]["rows"].items():
+            logger.info(f"  {table}: " + ", ".join(f"{n} {op}" for op, n in ops.items()))
+        for k, v in (extra or {}).items():
+            logger.info(f"  {k}: {v}")
+
+    def write_json(self, path: str, extra: dict = None):
+        d = self.to_dict()
+        d.update(extra or {})
+        _write_atomic(path, json.dumps(d, indent=2) + "\n")
+
+    def write_prometheus(self, path: str, extra: dict = None):
+        """ Write the node_exporter textfile format """
+        d = self.to_dict()
+        lines = [
+            "# TYPE duprly_run_seconds gauge",
+            f"duprly_run_seconds {d['wall_seconds']}",
+            "# TYPE duprly_http_requests_total counter",
+        ]
+        for name, h in d["http"].items():
+            for s, c in h["status"].items():
+                lines.append(f'duprly_http_requests_total{{call="{name}",status="{s}"}} {c}')
+        lines.append("# TYPE duprly_http_response_bytes_total counter")
+        lines += [f'duprly_http_response_bytes_total{{call="{n}"}} {h["bytes"]}'
+                  for n, h in d["http"].items()]
+        lines.append("# TYPE duprly_http_retries_total counter")
+        lines += [f'duprly_http_retries_total{{call="{n}"}} {h["retries"]}'
+                  for n, h in d["http"].items()]
+        lines.append("# TYPE duprly_http_request_seconds histogram")
+        for name in d["http"]:
+            lat = self.latency[name]
+            cumulative = 0
+            for b, c in zip(BUCKETS, lat.counts):
+                cumulative += c
+                le = "+Inf" if b == float("inf") else b
+                lines.append(f'duprly_http_request_seconds_bucket{{call="{name}",le="{le}"}} {cumulative}')
+            lines.append(f'duprly_http_request_seconds_sum{{call="{name}"}} {lat.total:.6f}')
+            lines.append(f'duprly_http_request_seconds_count{{call="{name}"}} {lat.n}')
+        db = d["db"]
+        lines += [
+            "# TYPE duprly_db_statements_total counter",
+            f"duprly_db_statements_total {db['statements']}",
+            "# TYPE duprly_db_sql_seconds_total counter",
+            f"duprly_db_sql_seconds_total {db['sql_seconds']}",
+            "# TYPE duprly_db_commits_total counter",
+            f"duprly_db_commits_total {db['commits']}",
+            "# TYPE duprly_db_commit_seconds_total counter",
+            f"duprly_db_commit_seconds_total {db['commit_seconds']}",
+            "# TYPE duprly_db_rows_total counter",
+        ]
+        for table, ops in db["rows"].items():
+            lines += [f'duprly_db_rows_total{{table="{table}",op="{op}"}} {n}' for op, n in ops.items()]
+        for k, v in (extra or {}).items():
+            lines += [f"# TYPE duprly_{k} gauge", f"duprly_{k} {v}"]
+        _write_atomic(path, "\n".join(lines) + "\n")
+
+
+def _write_atomic(path: str, text: str):
+    """ Write via a temp file so a scraper never reads half a file """
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        f.write(text)
+    os.replace(tmp, path)
@@ -0,0 +1,136 @@
+"""
+    Fetch / write pipeline for syncing with DUPR.
+
+    A pool of fetch worker threads calls the API and pushes decoded results
+    onto a bounded queue. A single writer thread drains the queue into one
+    SQLAlchemy session and commits in batches, so SQLite only ever sees
+    one writer while the network stays busy. When the writer falls behind
+    the queue fills up and the fetch workers block (backpressure).
+"""
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable
+
+from loguru import logger
+from sqlalchemy.orm import Session
+
+_DONE = object()
+
+
+class _Failed(object):
+    """ Queue item for a key whose fetch raised """
+
+    __slots__ = ("key",)
+
+    def __init__(self, key):
+        self.key = key
+
+
+class FetchWritePipeline(object):
+
+    def __init__(self, engine,
+                 fetch: Callable[[Any], Any],
+                 write: Callable[[Session, Any], int],
+                 workers: int = 4,
+                 queue_size: int = 64,
+                 batch_size: int = 500,
+                 batch_seconds: float = 2.0,
+                 fail: Callable[[Session, Any], None] = None):
+        """
+        fetch(key) is called on a worker thread and returns an item,
+        or None to skip. write(sess, item) is called on the writer thread
+        and returns the number of rows (matches) it added. fail(sess, key)
+        is called on the writer thread for a key whose fetch raised.
+        A batch is committed after batch_size rows or items, or
+        batch_seconds, whichever comes first.
+        """
+        self.engine = engine
+        self.fetch = fetch
+        self.write = write
+        self.fail = fail
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.batch_size = batch_size
+        self.batch_seconds = batch_seconds
+        self.stopped = threading.Event()
+        self.written = 0
+        self.commits = 0
+        self.error = None
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def _fetch_one(self, key):
+        if self.stopped.is_set():
+            return
+        try:
+            item = self.fetch(key)
+        except Exception:
+            logger.exception(f"fetch failed for {key}")
+            item = _Failed(key)
+        if item is not None:
+            self._put(item)
+
+    def _writer(self):
+        pending = 0  # rows
+        items = 0
+        last_commit = time.monotonic()
+        try:
+            with Session(self.engine) as sess:
+                while True:
+                    wait = max(0.0, self.batch_seconds - (time.monotonic() - last_commit))
+                    try:
+                        item = self.queue.get(timeout=wait)
+                    except queue.Empty:
+                        item = None
+                    if item is _DONE:
+                        break
+                    if isinstance(item, _Failed):
+                        if self.fail:
+                            self.fail(sess, item.key)
+                        items += 1
+                    elif item is not None:
+                        pending += self.write(sess, item)
+                        items += 1
+                    if pending >= self.batch_size or items >= self.batch_size or \
+                            time.monotonic() - last_commit >= self.batch_seconds:
+                        # also with no new rows, the items may have
+                        # written watermarks and frontier state
+                        if items:
+                            sess.commit()
+                            self.commits += 1
+                            self.written += pending
+                            logger.debug(f"pipeline commit {items} items, {pending} rows, "
+                                         f"{self.written} total")
+                        pending = 0
+                        items = 0
+                        last_commit = time.monotonic()
+                sess.commit()
+                self.commits += 1
+                self.written += pending
+        except Exception as e:
+            logger.exception("pipeline writer failed")
+            self.error = e
+            self.stopped.set()
+
+    def run(self, keys: Iterable) -> int:
+        """ Fetch every key and write the results, return rows written """
+        writer = threading.Thread(target=self._writer, name="dupr-writer")
+        writer.start()
+        with ThreadPoolExecutor(max_workers=self.workers,
+                                thread_name_prefix="dupr-fetch") as pool:
+            for _ in pool.map(self._fetch_one, keys):
+                pass
+        self._put(_DONE)
+        writer.join()
+        if self.error:
+            raise self.error
+        logger.info(f"pipeline wrote {self.written} rows in {self.commits} commits")
+        return self.written
@@ -0,0 +1,129 @@
+"""
+    Adaptive rate limiting for the DUPR API.
+
+    Each call family (history, player, club) has its own token bucket.
+    A bucket starts at its budget (requests per second) and adapts AIMD
+    style: every error (429 or 5xx) halves the rate, at most once per
+    second so a burst of concurrent failures counts as one, and every
+    success adds a little back until the budget is reached again.
+    A Retry-After on 429/503 blocks the whole family until then.
+
+    One RateLimiter is shared by all threads and async tasks of a client:
+    the bucket state is behind a lock, and acquire() / acquire_async()
+    only differ in how they wait for their reserved slot.
+"""
+import asyncio
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+from loguru import logger
+
+# requests per second
+DEFAULT_BUDGETS = {
+    "history": 10.0,
+    "player": 10.0,
+    "club": 5.0,
+    "default": 5.0,
+}
+
+FAMILIES = {
+    "get_member_match_history": "history",
+    "get_player": "player",
+    "get_profile": "player",
+    "get_club": "club",
+    "get_member_by_club": "club",
+}
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """ Retry-After as seconds from now, it can be seconds or an HTTP date """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+        return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket(object):
+
+    def __init__(self, name: str, budget: float, burst: float = None,
+                 min_rate: float = 0.2, increase: float = 0.05, decrease: float = 0.5):
+        self.name = name
+        self.budget = budget
+        self.rate = budget
+        self.burst = burst or max(1.0, budget)
+        self.min_rate = min_rate
+        self.increase = increase  # rate added per success
+        self.decrease = decrease  # rate multiplied by on error
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.last_decrease = 0.0
+        self.lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """ Take a token, return how long to wait before using it """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1.0
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            return max(wait, self.blocked_until - now)
+
+    def on_success(self):
+        with self.lock:
+            self.rate = min(self.budget, self.rate + self.increase)
+
+    def on_error(self, retry_after: float = None):
+        with self.lock:
+            now = time.monotonic()
+            if retry_after:
+                self.blocked_until = max(self.blocked_until, now + retry_after)
+            if now - self.last_decrease >= 1.0:
+                self.rate = max(self.min_rate, self.rate * self.decrease)
+                self.last_decrease = now
+                logger.debug(f"rate limit {self.name}: {self.rate:.2f}/s")
+
+
+class RateLimiter(object):
+
+    def __init__(self, budgets: dict = None):
+        budgets = dict(DEFAULT_BUDGETS, **(budgets or {}))
+        self.buckets = {name: TokenBucket(name, rps) for name, rps in budgets.items()}
+        self.throttled = 0
+
+    def bucket(self, name: str) -> TokenBucket:
+        """ Bucket for a call name (as passed to dupr_get/dupr_post) """
+        return self.buckets.get(FAMILIES.get(name, "default"), self.buckets["default"])
+
+    def acquire(self, name: str):
+        wait = self.bucket(name).reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self, name: str):
+        wait = self.bucket(name).reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def feedback(self, name: str, status: int, retry_after: str = None):
+        """ Adapt the rate to the outcome of a request """
+        bucket = self.bucket(name)
+        if status == 429 or status >= 500:
+            self.throttled += status == 429
+            seconds = parse_retry_after(retry_after) if status in (429, 503) else None
+            if status == 429:
+                logger.warning(f"throttled on {name}, retry after {seconds}")
+            bucket.on_error(seconds)
+        else:
+            bucket.on_success()
@@ -1,121 +1,197 @@
 """
+    Typed records for DUPR API json.
+
+    Hits are decoded once into these small __slots__ classes, which sort
+    out the API quirks (NR ratings, ratings nested or not, duprId vs id)
+    and check the fields the database needs, raising ValueError on a bad
+    hit (decode_players and decode_matches skip those). dupr_db writes
+    from them, so a page of matches never builds SQLAlchemy objects.
+
+    Response bodies are parsed with orjson when it is installed.
 """
 from datetime import date
-from operator import attrgetter
-from loguru import logger
+from typing import Optional
 
+from loguru import logger
 
-class Player:
-    def __init__(self):
-        self.id = None
-        self.dupr_id = ""
-        self.full_name = ""
-        self.image_url = ""
-        self.email = ""
-        self.gender = ""
-        self.age = 0
+try:
+    from orjson import loads
+except ImportError:
+    from json import loads  # noqa: F401
+
+
+def rating(v) -> Optional[float]:
+    """ A rating as float, None for NR or missing """
+    if v is None or v == "NR" or v == "":
+        return None
+    return float(v)
+
+
+def dupr_id(d: dict) -> Optional[int]:
+    """ The numeric DUPR id of player json.
+        Players in matches can have a duprId of the form NNNANNN where
+        other calls give a number, so id is used, duprId only if numeric.
+    """
+    v = d.get("id")
+    if v is None:
+        v = d.get("duprId")
+        if not isinstance(v, int) and not (isinstance(v, str) and v.isdigit()):
+            return None
+    return int(v)
+
+
+class Player(object):
+
+    __slots__ = ("dupr_id", "full_name", "image_url", "email", "gender", "age",
+                 "singles", "singles_verified", "singles_provisional",
+                 "doubles", "doubles_verified", "doubles_provisional")
+
+    def __init__(self, dupr_id: Optional[int], full_name: str = None, image_url: str = None,
+                 email: str = None, gender: str = None, age: int = None,
+                 singles: float = None, singles_verified: float = None, singles_provisional: bool = True,
+                 doubles: float = None, doubles_verified: float = None, doubles_provisional: bool = True):
+        self.dupr_id = dupr_id
+        self.full_name = full_name
+        self.image_url = image_url
+        self.email = email
+        self.gender = gender
+        self.age = age
+        self.singles = singles
+        self.singles_verified = singles_verified
+        self.singles_provisional = singles_provisional
+        self.doubles = doubles
+        self.doubles_verified = doubles_verified
+        self.doubles_provisional = doubles_provisional
+
+    def __repr__(self) -> str:
+        return f"Player {self.dupr_id} {self.full_name} {self.doubles} / {self.singles}"
+
+    @classmethod
+    def from_json(cls, d: dict) -> "Player":
+        """ Player from the player, club member or match player json.
+            The player call nests the ratings in "ratings", the others do not.
+            Raises ValueError without a numeric id, the database needs one.
+        """
+        try:
+            pid = dupr_id(d)
+            if pid is None:
+                raise ValueError("no numeric id")
+            r = d.get("ratings") or d
+            return cls(
+                pid,
+                d.get("fullName"),
+                d.get("imageUrl"),
+                d.get("email"),
+                d.get("gender"),
+                d.get("age"),
+                rating(r.get("singles")),
+                rating(r.get("singlesVerified")),
+                r.get("singlesProvisional") is not False,
+                rating(r.get("doubles")),
+                rating(r.get("doublesVerified")),
+                r.get("doublesProvisional") is not False,
+            )
+        except (AttributeError, TypeError, ValueError) as e:
+            raise ValueError(f"bad player json {d!r:.200}: {e}") from e
+
+
+class Team(object):
+
+    __slots__ = ("score1", "score2", "score3", "winner", "player1", "player2")
+
+    def __init__(self, score1: int, score2: int = None, score3: int = None, winner: bool = False,
+                 player1: Player = None, player2: Player = None):
+        self.score1 = score1
+        self.score2 = score2
+        self.score3 = score3
+        self.winner = winner
+        self.player1 = player1
+        self.player2 = player2
+
+    def __repr__(self) -> str:
+        return f"Team {self.player1} {self.player2} {self.score1}"
+
+    @classmethod
+    def from_json(cls, d: dict) -> "Team":
+        p2 = d.get("player2")
+        return cls(
+            d.get("game1"),
+            d.get("game2"),
+            d.get("game3"),
+            bool(d.get("winner")),
+            Player.from_json(d["player1"]),
+            Player.from_json(p2) if p2 else None,
+        )
+
+    def players(self) -> list:
+        return [self.player1, self.player2] if self.player2 else [self.player1]
+
+
+class Match(object):
+
+    __slots__ = ("match_id", "name", "event_date", "event_format", "match_type",
+                 "match_source", "match_score_added", "teams")
+
+    def __init__(self, match_id: int, name: str, event_date: str, event_format: str = None,
+                 match_type: str = "", match_source: str = "", match_score_added: bool = True,
+                 teams: list = None):
+        self.match_id = match_id
+        self.name = name
+        self.event_date = event_date  # YYYY-MM-DD
+        self.event_format = event_format
+        self.match_type = match_type
+        self.match_source = match_source
+        self.match_score_added = match_score_added
+        self.teams = teams or []
+
+    def __repr__(self) -> str:
+        return f"Match {self.match_id} {self.name} on {self.event_date}"
+
+    @classmethod
+    def from_json(cls, d: dict) -> "Match":
+        """ Match from a match history hit, with its teams and players """
+        try:
+            return cls(
+                int(d["matchId"]),
+                # need to try different fields...
+                d.get("eventName") or d.get("league") or d.get("tournament", ""),
+                date.fromisoformat(d["eventDate"]).isoformat(),
+                d.get("eventFormat"),
+                d.get("matchType") or "",
+                d.get("matchSource") or "",
+                d.get("matchScoreAdded") is not False,
+                [Team.from_json(t) for t in d["teams"]],
+            )
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            raise ValueError(f"bad match json {d.get('matchId')}: {e!r}") from e
+
+    def is_double(self) -> bool:
+        return self.event_format == "DOUBLES"  # not "SINGLES"
 
-        self.singles = "NR"
-        self.singles_verified = "NR"
-        self.singles_provisional = False
+    def players(self) -> list:
+        """ Players of both teams """
+        return [p for t in self.teams for p in t.players()]
 
-        self.doubles = "NR"
-        self.doubles_verified = "NR"
-        self.doubles_provisional = False
 
-    def from_json(self, d: dict) -> 'Player':
+def decode_players(hits: list) -> list:
+    """ Player records of player json hits, skipping (and logging) bad hits """
+    players = []
+    for d in hits:
         try:
-            self.id = d.get("id")
-            self.dupr_id = d.get("duprId")
-            self.full_name = d.get("fullName")
-            self.image_url = d.get("imageUrl")
-
-            self.email = d.get("email")
-            self.gender = d.get("gender")
-            self.age = d.get("age")
-
-            self.singles = d.get("singles")
-            self.singlesVerified = d.get("singlesVerified")
-            self.singlesProvisional = d.get("singlesProvisional")
-
-            self.doubles = d.get("doubles")
-            self.doublesVerified = d.get("doublesVerified")
-            self.doublesProvisional = d.get("doublesProvisional")
-            return self
-        except:
-            logger.exception(d)
-            raise
-
-
-class Team:
-    def __init__(self):
-        self.game_score1 = -1
-        self.game_score2 = -1
-        self.game_score3 = -1
-        self.winner = False
-        self.player1 = None
-        self.player2 = None
-
-    def from_json(self, d: dict) -> 'Team':
+            players.append(Player.from_json(d))
+        except ValueError as e:
+            logger.warning(f"skip {e}")
+    return players
+
+
+def decode_matches(hits: list) -> list:
+    """ Match records of a match history page, skipping (and logging) bad hits,
+        so one bad hit does not lose the rest of the page
+    """
+    matches = []
+    for d in hits:
         try:
-            self.game_score1 = d.get("game1")
-            self.game_score2 = d.get("game2")
-            self.game_score3 = d.get("game3")
-            self.player1 = Player().from_json(d.get("player1"))
-            p2 = d.get("player2")
-            if p2:
-                self.player2 = Player().from_json(d.get("player2"))
-            self.winner = d.get("winner")
-            return self
-        except:
-            logger.exception(d)
-            print(d)
-            raise
-
-
-class Match:
-    def __init__(self):
-        self.id = 0
-        self.match_id = 0
-        self.user_id = 0
-        self.display_identity = ""
-        self.event_date = None
-        self.confirmed = False
-        self.event_format = ""
-        self.match_score_added = False
-        self.match_source = None  # dupr, manual, league
-        self.match_type = None  # side_only vs rally
-
-        self.teams = []
-
-    def team1(self):
-        if self.teams[0]:
-            return self.teams[0]
-
-    def team2(self):
-        if self.teams[1]:
-            return self.teams[1]
-
-    def is_double(self):
-        return self.event_format == "DOUBLES"  # not "SINGLES"
-
-    def __repr__(self):
-        t = self.team1()
-        s = f"player1: {t.player1}"
-        return s
-
-    def from_json(self, d: dict) -> 'Match':
-        self.match_id = d.get("matchId")
-        self.user_id = d.get("userId")
-        self.display_identity = d.get("displayIdentity")
-        self.confirmed = d.get("confirmed")
-        self.event_date = date.fromisoformat(d.get("eventDate"))
-        self.event_format = d.get("eventFormat")
-        self.match_score_added = d.get("matchScoreAdded")
-        self.match_source = d.get("matchSource")
-        self.match_type = d.get("matchType")        
-
-        for jt in d.get("teams"):
-            t = Team().from_json(jt)
-            self.teams.append(t)
-        return self
\ No newline at end of file
+            matches.append(Match.from_json(d))
+        except ValueError as e:
+            logger.warning(f"skip {e}")
+    return matches
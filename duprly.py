@@ -1,297 +1,263 @@
-import os
-from loguru import logger
-import click
-import json
-from dupr_client import DuprClient
-from openpyxl import Workbook
-from dotenv import load_dotenv
-from sqlalchemy import select, delete
-from sqlalchemy.orm import Session
-from dupr_db import open_db, Base, Player, Match, MatchTeam, Rating, MatchDetail
-
-load_dotenv()
-dupr = DuprClient()
-
-eng = open_db()
-with Session(eng) as sess:
-    Base.metadata.create_all(eng)
-
-
-def ppj(data):
-    logger.debug(json.dumps(data, indent=4))
-
-
-def dupr_auth():
-    username = os.getenv("DUPR_USERNAME")
-    password = os.getenv("DUPR_PASSWORD")
-    dupr.auth_user(username, password)
+"""
+    duprly command line.
 
+    This module only defines the commands and their options, so --help and
+    option errors do not pay for importing SQLAlchemy, requests or openpyxl.
+    The work is done in dupr_commands, imported when a command runs.
+"""
+import os
+import sys
 
-def get_player_from_dupr(pid: int) -> Player:
-
-    rc, pdata = dupr.get_player(pid)
-    logger.debug(f"dupr.get_player for id {pid} GET...")
-    ppj(pdata)
+import click
 
-    player = None
+from dupr_config import DB_PROFILES, EXPORT_TABLES, EXPORT_FORMATS, RATING_BUDGET, db_config
 
-    with Session(eng) as sess:
-        player = Player().from_json(pdata)
-        logger.debug(f"{player.dupr_id}, {player.full_name}, {player.rating}")
-        Player.save(sess, player)
-        sess.commit()
+# cli group options, handed to dupr_commands.configure()
+OPTIONS = {}
 
-    return player
 
+def app():
+    """ dupr_commands, configured with the cli group options """
+    import dupr_commands
 
-def get_all_players_from_dupr():
-    club_id = os.getenv("DUPR_CLUB_ID")
-    _rc, players = dupr.get_members_by_club(club_id)
-    for pdata in players:
-        with Session(eng) as sess:
-            player = Player().from_json(pdata)
-            logger.debug(f"{player.id}, {player.full_name}, {player.rating}")
-            Player.save(sess, player)
-            sess.commit()
+    dupr_commands.configure(**OPTIONS)
+    return dupr_commands
 
 
-def get_matches_from_dupr(dupr_id: int):
-    """ Get match history for specified player """
-
-    _rc, matches = dupr.get_member_match_history_p(dupr_id)
-
-    with Session(eng) as sess:
-
-        for mdata in matches:
-            print("match")
-            ppj(mdata)
-            m = Match().from_json(mdata)
-            # now we have match, and potentially four new players
-            # deal with the fact that player may already exists
-            m1 = Match.get_by_id(sess, m.match_id)
-            if m1:
-                # update
-                continue  # skip
-
-            for team in m.teams:
-                print(f"team {team}")
-                plist = []
-                for p in team.players:
-                    # This is very kludgy, the player data returned from the MatchHistory
-                    # call only has a few fields
-                    p1 = sess.execute(select(Player).where(
-                        Player.dupr_id == p.dupr_id)).scalar_one_or_none()
-                    if p1:
-                        # set team to this player object instead
-                        plist.append(p1)
-                        print(f"use existing populated player")
-                    else:
-                        # We need to handle a strange case where the same player
-                        # enter himself/herself twice on a doubles team.
-                        # If we just add both "new limited (but same)" team members
-                        # SQLA seems to happily add both?
-                        # so check to see if p already has been added:
-                        if len(plist) > 0 and plist[0].dupr_id == p.dupr_id:
-                            logger.warning(f"same player on doubles team {p.dupr_id} {m.match_id}")
-                            continue
-                        plist.append(p)
-                        print(f"saved new limited data player")
-                team.players = plist
-            sess.add(m)
-            sess.commit()
-
-
-def update_ratings_from_dupr():
-
-    with Session(eng) as sess:
-        # Has to use "has" not "any" because it is 1=1? Also need to have something
-        # in the has() function
-        dupr_ids = sess.scalars(select(Player.dupr_id).where(
-            ~Player.rating.has(Rating.doubles)))
-
-    for i in dupr_ids:
-        get_player_from_dupr(i)
-
-
-@click.command()
-def build_match_detail():
-    """ Flatten match data for faster query """
-    with Session(eng) as sess:
-        sess.execute(delete(MatchDetail))
-        matches = sess.scalars(select(Match))
-        for match in matches:
-            print(match)
-            md = MatchDetail()
-            md.match = match
-            t1 = match.teams[0]
-            md.team_1_score = t1.score1
-            md.team_1_player_1_id = t1.players[0].id
-            if len(t1.players) > 1:
-                md.team_1_player_2_id = t1.players[1].id
-            t2 = match.teams[1]
-            md.team_2_score = t2.score1
-            md.team_2_player_1_id = t2.players[0].id
-            if len(t2.players) > 1:
-                md.team_2_player_2_id = t2.players[1].id
-            sess.add(md)
-            sess.commit()
-
-
-def match_row(m: Match) -> tuple:
-    return (m.match_id, m.user_id, m.display_identity, m.event_date, m.confirmed, m.event_format, m.match_type)
-
-
-def team_row(t: MatchTeam, ratings) -> tuple:
-    doubles1 = ratings.get(t.player1.id, ("NA", "NA", "NA"))[2]
-    if t.player2:
-        doubles2 = ratings.get(t.player2.id, ("NA", "NA", "NA"))[2]
-        p2_row = (t.player2.dupr_id, t.player2.full_name, doubles2)
-    else:
-        doubles2 = "NA"
-        p2_row = ("", "", "NA")
-
-    return (t.player1.dupr_id, t.player1.full_name, doubles1) + p2_row + (t.game_score1,)
-
-
-@click.command()
-def write_excel():
-    from openpyxl.styles import numbers
-
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "players"
-    # cache all ratings
-    player_ratings = {}
-
-    ws.append(("id", "DUPR id", "full name", "gender", "age") +
-              ("single", "single verified", "single provisional") +
-              ("double", "double verified", "double provisional")
-              )
-
-    for d in ptable:
-        p = Player().from_json(d)
-        ws.append((
-            p.id, p.dupr_id, p.full_name, p.gender, p.age,
-            p.singles, p.singles_verified, p.singles_provisional,
-            p.doubles, p.doubles_verified, p.doubles_provisional))
-        player_ratings[p.id] = (p.singles, p.singles_verified, p.doubles, p.doubles_verified)
-
-    col = ws.column_dimensions['A']
-    col.number_format = u'#,##0'
-
-    ws = wb.create_sheet("matches")
-
-    prow = ("player1 DUPR ID", "player 1", "player1 doubles",
-            "player2 DUPR ID", "player 2", "player2 doubles",
-            "score1")
-    ws.append(("match id", "user_id", "match display", "event date", "confirmed", "format", "match type") +
-            prow + prow)
-    for d in mtable:
-        m = Match().from_json(d)
-        t1 = m.teams[0]
-        t2 = m.teams[1]
-        ws.append((match_row(m) + team_row(m.teams[0], player_ratings) +
-                    team_row(m.teams[1], player_ratings)))
-
-    col = ws.column_dimensions['A']
-    col.number_format = u'#,##0'
-    col = ws.column_dimensions['B']
-    col.number_format = u'#,##0'
-    col = ws.column_dimensions['J']
-    col.format = numbers.FORMAT_TEXT
-
-    wb.save(filename="dupr.xlsx")
-
-
-@click.command()
+@click.group()
+@click.option("--db", envvar="DUPR_DB_PATH", help="sqlite database path (default dupr.sqlite)")
+@click.option("--db-profile", envvar="DUPR_DB_PROFILE", type=click.Choice(list(DB_PROFILES)),
+              help="storage profile, fast uses WAL and relaxed syncing")
+@click.option("--no-cache", is_flag=True, help="do not use the API response cache")
+@click.option("--record", is_flag=True, help="fetch everything and record it in the response cache")
+@click.option("--replay", is_flag=True, help="only use recorded responses, no network access")
+@click.option("--archive-dir", envvar="DUPR_ARCHIVE_DIR", help="raw response archive (default dupr_archive)")
+@click.option("--no-archive", is_flag=True, help="do not archive raw API responses")
+@click.option("--no-rate-limit", is_flag=True, help="do not pace requests to the API")
+@click.option("--metrics-json", help="write run metrics as json to this file")
+@click.option("--metrics-prom", help="write run metrics as a prometheus textfile")
+@click.option("--profile", is_flag=True, help="profile the command with cProfile (saved to duprly.prof)")
+def cli(db: str, db_profile: str, no_cache: bool, record: bool, replay: bool,
+        archive_dir: str, no_archive: bool, no_rate_limit: bool,
+        metrics_json: str, metrics_prom: str, profile: bool):
+    if record and replay:
+        raise click.UsageError("use only one of --record and --replay")
+    OPTIONS.update(
+        db=db,
+        db_profile=db_profile,
+        cache_mode="off" if no_cache else "record" if record else "replay" if replay else "ttl",
+        archive_dir=archive_dir,
+        archive=not no_archive,
+        rate_limit=not no_rate_limit,
+    )
+    ctx = click.get_current_context()
+    ctx.call_on_close(lambda: report_metrics(metrics_json, metrics_prom))
+    if profile:
+        import cProfile
+        prof = cProfile.Profile()
+        ctx.call_on_close(lambda: report_profile(prof))
+        prof.enable()
+
+
+def report_metrics(json_path: str = None, prom_path: str = None):
+    """ Summary of the run, if the command did any work """
+    commands = sys.modules.get("dupr_commands")
+    if commands:
+        commands.report_metrics(json_path, prom_path)
+
+
+def report_profile(prof, path: str = "duprly.prof", top: int = 25):
+    """ Save the profile and print the top functions by cumulative time.
+        Only the main thread is profiled, fetch worker threads are not.
+    """
+    import pstats
+    from loguru import logger
+
+    prof.disable()
+    prof.dump_stats(path)
+    pstats.Stats(prof).sort_stats("cumulative").print_stats(top)
+    logger.info(f"profile saved to {path}")
+
+
+@cli.command()
+@click.option("--concurrency", default=1, help="number of concurrent history fetches")
+@click.option("--pipeline", is_flag=True, help="fetch on worker threads, write in batches")
+@click.option("--workers", default=4, help="number of pipeline fetch workers")
+@click.option("--batch-size", default=500, help="pipeline: commit every N matches")
+@click.option("--batch-seconds", default=2.0, help="pipeline: commit at least every N seconds")
+@click.option("--incremental", is_flag=True, help="stop paging at already known matches")
+@click.option("--max-depth", default=1,
+              help="crawl players this many hops from the club (0 is only club members)")
+@click.option("--resume", is_flag=True, help="continue an interrupted crawl where it stopped")
+@click.option("--rating-budget", default=RATING_BUDGET, help="most player rating requests to make")
+def get_data(concurrency: int, pipeline: bool, workers: int, batch_size: int, batch_seconds: float,
+             incremental: bool, max_depth: int, resume: bool, rating_budget: int):
+    """ Update all data.
+        Club members are crawled first, then the players met in their
+        matches, up to --max-depth hops away. The crawl frontier is kept
+        in the database, so an interrupted crawl can be --resume'd.
+    """
+    app().get_data(concurrency, pipeline, workers, batch_size, batch_seconds,
+                   incremental, max_depth, resume, rating_budget)
+
+
+@cli.command()
+@click.option("--output", default="dupr.xlsx", help="excel file to write")
+@click.option("--since", help="only matches on or after this date (YYYY-MM-DD)")
+@click.option("--until", help="only matches on or before this date (YYYY-MM-DD)")
+@click.option("--club", help="only players of this club, and matches with them")
+def write_excel(output: str, since: str, until: str, club: str):
+    """ Write players and match report to an excel file.
+        Rows are streamed from the database into a write-only workbook,
+        so memory use does not grow with the number of matches.
+    """
+    app().write_excel(output, since, until, club)
+
+
+@cli.command()
 def stats():
-    with Session(eng) as sess:
-        c = sess.query(Player).count()
-        print(f"number of players {c}")
-        c = sess.query(Match).count()
-        print(f"number of matches {c}")
+    """ Number of players and matches in the database """
+    # plain sqlite3, this is often run just to check on a sync
+    import sqlite3
+
+    path, _profile = db_config(OPTIONS.get("db"))
+    counts = {"player": 0, "match": 0}
+    if os.path.exists(path):
+        con = sqlite3.connect(path)
+        try:
+            for table in counts:
+                try:
+                    counts[table] = con.execute(f'SELECT count(*) FROM "{table}"').fetchone()[0]
+                except sqlite3.OperationalError:
+                    pass  # not created yet
+        finally:
+            con.close()
+    print(f"number of players {counts['player']}")
+    print(f"number of matches {counts['match']}")
+
+
+@cli.command()
+def get_all_players():
+    commands = app()
+    commands.dupr_auth()
+    commands.get_all_players_from_dupr()
 
 
-@click.command()
+@cli.command()
 @click.argument("pid")
 def get_player(pid: int):
     """ Get player from DUPR by ID """
-    dupr_auth()
-    get_player_from_dupr(pid)
+    commands = app()
+    commands.dupr_auth()
+    commands.get_player_from_dupr(pid)
 
 
-@click.command()
+@cli.command()
 @click.argument("pid")
 def delete_player(pid: int):
     """ Get player from DUPR if necessary """
+    from loguru import logger
+
     logger.debug(f"delete player {pid} from database")
     pass
 
 
-@click.command()
-def update_ratings():
-    dupr_auth()
-    update_ratings_from_dupr()
-
-
-@click.command()
-def test_db():
-    dupr_auth()
-    club_id = os.getenv("DUPR_CLUB_ID")
-    _rc, players = dupr.get_members_by_club(club_id)
-    return
-    with Session(eng) as sess:
-        # Has to use "has" not "any" because it is 1=1? Also need to have something
-        # in the has() function
-        # use sess.scalars instead of execute(...).scalars() for more concise use
-        dupr_ids = sess.scalars(select(Player.dupr_id).where(
-            ~Player.rating.has(Rating.doubles)))
-    for i in dupr_ids:
-        print(i)
-
-
-@click.command()
-def get_all_players():
-    dupr_auth()
-    get_all_players_from_dupr()
-
-
-@click.command()
+@cli.command()
 @click.argument("dupr_id")
-def get_matches(dupr_id: int):
+@click.option("--incremental", is_flag=True, help="stop at already known matches")
+def get_matches(dupr_id: int, incremental: bool):
     """ Get match history for specified player """
-    dupr_auth()
-    get_matches_from_dupr(dupr_id)
+    commands = app()
+    commands.dupr_auth()
+    commands.get_matches_from_dupr(dupr_id, incremental)
 
 
-@click.command()
-def get_data():
-    """ Update all data """
-    logger.info("Getting data from DUPR...")
-    dupr_auth()
-    get_all_players_from_dupr()
-    with Session(eng) as sess:
-        for p in sess.execute(select(Player)).scalars():
-            get_matches_from_dupr(p.dupr_id)
+@cli.command()
+@click.option("--budget", default=RATING_BUDGET, help="most player requests to make")
+@click.option("--concurrency", default=4, help="number of concurrent player fetches")
+@click.option("--max-age", default=30, help="refresh ratings older than this many days anyway")
+def update_ratings(budget: int, concurrency: int, max_age: int):
+    """ Refresh the player ratings most likely to have changed """
+    commands = app()
+    commands.dupr_auth()
+    commands.update_ratings_from_dupr(budget, concurrency, max_age)
 
-    update_ratings_from_dupr()
 
+@cli.command()
+@click.option("--incremental", is_flag=True, help="only add matches missing from match_detail")
+def build_match_detail(incremental: bool):
+    """ Flatten match data for faster query """
+    app().update_match_detail(incremental)
 
-@click.group()
-def cli():
-    pass
+
+@cli.command()
+def test_db():
+    app().test_db()
+
+
+@cli.command()
+def rebuild_db():
+    """ Rebuild a new database from the raw response archive, offline """
+    app().rebuild_db()
+
+
+@cli.command()
+@click.argument("tables", nargs=-1, type=click.Choice(list(EXPORT_TABLES)))
+@click.option("--format", "fmt", type=click.Choice(EXPORT_FORMATS), default="csv", help="output format")
+@click.option("--output", default="-",
+              help="output file, or directory for several tables, - for stdout")
+@click.option("--since", help="only matches on or after this date (YYYY-MM-DD), and their players")
+@click.option("--batch-size", default=10000, help="rows per batch / parquet row group")
+def export(tables: tuple, fmt: str, output: str, since: str, batch_size: int):
+    """ Export tables (default all) as csv, ndjson or parquet """
+    tables = tables or tuple(EXPORT_TABLES)
+    if len(tables) > 1 and output == "-":
+        raise click.UsageError("give an --output directory to export several tables")
+    if fmt == "parquet" and output == "-":
+        raise click.UsageError("parquet export needs --output")
+    app().export(tables, fmt, output, since, batch_size)
+
+
+@cli.command()
+@click.option("--scale", default=0.5, help="rating difference scale of the win probability curve")
+@click.option("--upset-threshold", default=0.35, help="winner's expected probability below this is an upset")
+def analyze(scale: float, upset_threshold: float):
+    """ Compute per match rating analytics into match_analytics """
+    app().analyze(scale, upset_threshold)
+
+
+@cli.command()
+def build_summary():
+    """ Full refresh of the player summary tables """
+    app().update_player_summary()
+
+
+@cli.command("rating-as-of")
+@click.argument("when")
+@click.argument("dupr_ids", nargs=-1, type=int)
+@click.option("--club", help="only members of this club")
+def show_rating_as_of(when: str, dupr_ids: tuple, club: str):
+    """ Player ratings as they were at WHEN (YYYY-MM-DD), for some or all players """
+    app().show_rating_as_of(when, dupr_ids, club)
+
+
+@cli.command("rating-change")
+@click.argument("start")
+@click.argument("end")
+@click.argument("dupr_ids", nargs=-1, type=int)
+@click.option("--club", help="only members of this club")
+def show_rating_change(start: str, end: str, dupr_ids: tuple, club: str):
+    """ How player ratings changed from START to END (YYYY-MM-DD) """
+    app().show_rating_change(start, end, dupr_ids, club)
+
+
+def main():
+    """ Console script entry point """
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    cli()
 
 
 if __name__ == "__main__":
-    logger.add("duprly_{time}.log")
-    cli.add_command(get_data)
-    cli.add_command(write_excel)
-    cli.add_command(stats)
-    cli.add_command(get_all_players)
-    cli.add_command(get_player)
-    cli.add_command(delete_player)
-    cli.add_command(get_matches)
-    cli.add_command(update_ratings)
-    cli.add_command(build_match_detail)
-    cli.add_command(test_db)
-    cli()
+    main()